@@ -0,0 +1,253 @@
+"""Parsed test definition cache shared by test-runner and the repository tools.
+
+Test definitions, and the other YAML files of the repository, are parsed once
+per content: the parsed data is stored as JSON in a cache directory under the
+SHA-1 of the file content, so the next load of the same content, from the same
+or another tool, only decodes the JSON. Documents JSON can't represent exactly
+(dates, integer keys...) are parsed every time. The cache keeps the
+MAX_CACHE_ENTRIES most recently used entries. The cache directory defaults to
+~/.cache/test-definitions/yaml and can be changed with the
+TESTDEF_CACHE_DIR environment variable; setting it to an empty string
+disables the disk cache.
+"""
+
+from dataclasses import dataclass, field
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import yaml
+
+# Bump when the cached representation changes.
+CACHE_VERSION = "2"
+
+# Entries kept in the disk cache, a few times the YAML files of the repository.
+MAX_CACHE_ENTRIES = 4000
+
+# libyaml based loader when PyYAML was built with it.
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# JSON encoded data by content hash, for files loaded several times by a
+# process.
+_memory_cache: Dict[str, str] = {}
+
+# Whether the disk cache was pruned by this process.
+_pruned = False
+
+# Names of the files the cache creates: entries of any cache version,
+# including the pickled entries of version 1, and temporary files.
+_ENTRY_RE = re.compile(r"^[0-9a-f]{40}-[^.]+\.(json|pickle)$")
+_TMP_PREFIX = ".tmp-"
+
+
+@dataclass
+class TestDef:
+    """Parsed YAML file, with typed access to the test definition fields.
+
+    Attributes:
+        path: File the test definition was loaded from.
+        sha1: SHA-1 of the file content.
+        data: The complete parsed document.
+    """
+
+    path: str
+    sha1: str
+    data: Any = field(repr=False)
+
+    @property
+    def kind(self) -> str:
+        """'testdef', 'skipgen' or 'unknown', as told by the top level keys."""
+        if isinstance(self.data, dict):
+            if "run" in self.data:
+                return "testdef"
+            if "skiplist" in self.data:
+                return "skipgen"
+        return "unknown"
+
+    @property
+    def metadata(self) -> Dict[str, Any]:
+        return self.data.get("metadata") or {}
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.metadata.get("name")
+
+    @property
+    def format(self) -> str:
+        return self.metadata.get("format", "")
+
+    @property
+    def is_manual(self) -> bool:
+        return self.format.startswith("Manual Test Definition")
+
+    @property
+    def params(self) -> Dict[str, Any]:
+        return self.data.get("params") or {}
+
+    @property
+    def steps(self) -> List[Any]:
+        return (self.data.get("run") or {}).get("steps") or []
+
+    @property
+    def parse_pattern(self) -> Optional[str]:
+        return (self.data.get("parse") or {}).get("pattern")
+
+    @property
+    def fixupdict(self) -> Optional[Dict[str, str]]:
+        return (self.data.get("parse") or {}).get("fixupdict")
+
+
+def cache_dir() -> Optional[str]:
+    """Return the disk cache directory, None if disabled."""
+    path = os.environ.get("TESTDEF_CACHE_DIR")
+    if path is None:
+        path = os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "test-definitions",
+            "yaml",
+        )
+    return path or None
+
+
+def _cache_path(sha1: str) -> Optional[str]:
+    directory = cache_dir()
+    if directory is None:
+        return None
+    return os.path.join(directory, "%s-%s.json" % (sha1, CACHE_VERSION))
+
+
+def _read_cache(sha1: str) -> Optional[str]:
+    if sha1 in _memory_cache:
+        return _memory_cache[sha1]
+    path = _cache_path(sha1)
+    if path is None:
+        return None
+    try:
+        with open(path, "r") as f:
+            encoded = f.read()
+        # Most recently used entries are kept when the cache is pruned.
+        os.utime(path)
+        return encoded
+    except OSError:
+        return None
+
+
+def _prune_cache(directory: str) -> None:
+    """Remove the entries of other cache versions and stale temporary files,
+    then the least recently used entries over MAX_CACHE_ENTRIES. Files the
+    cache didn't create are left alone."""
+    suffix = "-%s.json" % CACHE_VERSION
+    entries = []
+    stale = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                match = _ENTRY_RE.match(entry.name)
+                if match is None and not entry.name.startswith(_TMP_PREFIX):
+                    continue
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if match is None:
+                    # Possibly being written by another process.
+                    if mtime < time.time() - 3600:
+                        stale.append(entry.path)
+                elif entry.name.endswith(suffix):
+                    entries.append((mtime, entry.path))
+                else:
+                    stale.append(entry.path)
+    except OSError:
+        return
+    entries.sort()
+    if len(entries) > MAX_CACHE_ENTRIES:
+        # Down to three quarters of the limit, not to prune again on every run.
+        stale += [
+            path for mtime, path in entries[: len(entries) - MAX_CACHE_ENTRIES * 3 // 4]
+        ]
+    for path in stale:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _write_cache(sha1: str, encoded: str) -> None:
+    global _pruned
+    _memory_cache[sha1] = encoded
+    path = _cache_path(sha1)
+    if path is None:
+        return
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if not _pruned:
+            _pruned = True
+            _prune_cache(directory)
+        # Written to a temporary file first, concurrent readers never see a
+        # partial entry.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=_TMP_PREFIX)
+        with os.fdopen(fd, "w") as f:
+            f.write(encoded)
+        os.replace(tmp_path, path)
+    except OSError:
+        # The cache is an optimization only, e.g. a read-only home.
+        pass
+
+
+def _encode(data: Any) -> Optional[str]:
+    """Return data as JSON, None if JSON doesn't represent it exactly."""
+    try:
+        encoded = json.dumps(data)
+    except (TypeError, ValueError):
+        return None
+    if json.loads(encoded) != data:
+        return None
+    return encoded
+
+
+def load_content(content: bytes, path: str = "<string>") -> TestDef:
+    """Parse YAML content, using the cache.
+
+    Arguments:
+        content: Raw YAML document.
+        path: File name, for error messages and TestDef.path.
+    Return:
+        The parsed document. Every call returns a new copy, which the caller
+        may modify.
+    Raises:
+        yaml.YAMLError: The content isn't valid YAML. Errors are not cached.
+    """
+    sha1 = hashlib.sha1(content).hexdigest()
+    encoded = _read_cache(sha1)
+    if encoded is not None:
+        try:
+            data = json.loads(encoded)
+        except ValueError:
+            encoded = None
+    if encoded is None:
+        data = yaml.load(content.decode("utf-8"), Loader=SafeLoader)
+        encoded = _encode(data)
+        if encoded is not None:
+            _write_cache(sha1, encoded)
+    else:
+        _memory_cache[sha1] = encoded
+    return TestDef(path=path, sha1=sha1, data=data)
+
+
+def load(path: str) -> TestDef:
+    """Parse the YAML file at path, using the cache.
+
+    Raises:
+        OSError: The file can't be read.
+        yaml.YAMLError: The file isn't valid YAML.
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+    return load_content(content, path)
@@ -1,17 +1,34 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import contextlib
 import csv
 import cmd
+import codecs
 import copy
+import cProfile
+import fcntl
+import gzip
+import hashlib
+import heapq
 import json
 import logging
+import math
+import multiprocessing
 import netrc
 import os
 import re
+import resource
+import select
 import shlex
 import shutil
+import signal
+import sqlite3
+import statistics
 import subprocess
 import sys
+import tarfile
+import tempfile
 import textwrap
 import time
 from uuid import uuid4
@@ -21,8 +38,6 @@ from distutils.spawn import find_executable
 
 try:
     from squad_client.core.api import SquadApi
-    from squad_client.shortcuts import submit_results
-    from squad_client.core.models import Squad
     from urllib.parse import urlparse
 except ImportError as e:
     logger = logging.getLogger("RUNNER")
@@ -38,6 +53,18 @@ except ImportError as e:
     print("pip3 install -r ${REPO_PATH}/automated/utils/requirements.txt")
     sys.exit(1)
 
+# libyaml based loader, several times faster on large test plans. Falls
+# back to the pure Python loader when PyYAML was built without libyaml.
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../lib"))
+import py_testdef_lib  # nopep8
+
+
+def test_key(test):
+    """Return a hashable key identifying a test plan entry by its content."""
+    return json.dumps(test, sort_keys=True)
+
 
 class StoreDictKeyPair(argparse.Action):
     def __init__(self, option_strings, dest, nargs=None, **kwargs):
@@ -61,12 +88,58 @@ class StoreDictKeyPair(argparse.Action):
 SSH_PARAMS = "-o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -o ServerAliveInterval=5"
 
 
+class SSHMultiplexer(object):
+    """
+    Share one ssh connection to the target between all ssh and scp calls.
+
+    start() creates a directory for an OpenSSH control socket. The first
+    connection to the target becomes the control master and stays in the
+    background, so every later ssh/scp call reuses it instead of doing a full
+    key exchange. The state lives in the class, so worker processes started
+    by TestScheduler inherit it.
+
+    round_trips counts the ssh/scp processes started by this process. It is
+    reset for every test by run_test().
+    """
+
+    control_dir = None
+    round_trips = 0
+
+    @classmethod
+    def start(cls):
+        # Keep the socket path short, unix socket paths are limited in size.
+        cls.control_dir = tempfile.mkdtemp(prefix="test-runner-ssh-")
+
+    @classmethod
+    def stop(cls, target):
+        if cls.control_dir is None:
+            return
+        subprocess.call(
+            shlex.split("ssh %s -O exit %s" % (cls.params(), target)),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        shutil.rmtree(cls.control_dir, ignore_errors=True)
+        cls.control_dir = None
+
+    @classmethod
+    def params(cls):
+        """Return ssh/scp options, including multiplexing when enabled."""
+        cls.round_trips += 1
+        if cls.control_dir is None:
+            return SSH_PARAMS
+        return "%s -o ControlMaster=auto -o ControlPath=%s -o ControlPersist=yes" % (
+            SSH_PARAMS,
+            os.path.join(cls.control_dir, "%C"),
+        )
+
+
 def run_command(command, target=None):
     """Run a shell command. If target is specified, ssh to the given target first."""
 
     run = command
     if target:
-        run = 'ssh {} {} "{}"'.format(SSH_PARAMS, target, command)
+        run = 'ssh {} {} "{}"'.format(SSHMultiplexer.params(), target, command)
 
     logger = logging.getLogger("RUNNER.run_command")
     logger.debug(run)
@@ -76,6 +149,265 @@ def run_command(command, target=None):
         return subprocess.check_output(shlex.split(run)).strip().decode("utf-8")
 
 
+# Home directory of the login user of each target.
+target_homes = {}
+
+
+def target_home(target):
+    """
+    Return the home directory on target, asked once per target. check_target()
+    resolves it before tests are forked, so every test process inherits it.
+    """
+    if target not in target_homes:
+        target_homes[target] = run_command("echo $HOME", target)
+    return target_homes[target]
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on path while the block runs."""
+    with open(path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def results_lock(output):
+    """Serialize updates of the aggregated result files in output."""
+    return file_lock(os.path.join(output, ".result.lock"))
+
+
+class Timings(object):
+    """
+    Wall time and peak memory of the phases of the test being run.
+
+    Phases are recorded with the Timings.phase() context manager, from
+    anywhere in the pipeline, and reset by run_test() for every test like
+    SSHMultiplexer.round_trips. A phase started inside another one is
+    recorded as "parent/child" and its time is included in the parent.
+    Every test appends its phases to <output>/.timings.jsonl; finalize()
+    writes them to <output>/timings.json and logs a summary table.
+    """
+
+    phases = []
+    stack = []
+    # Peak RSS of each phase in the stack, before the last reset.
+    peaks = []
+    origin = 0.0
+
+    @classmethod
+    def reset(cls):
+        cls.phases = []
+        cls.stack = []
+        cls.peaks = []
+        cls.origin = time.monotonic()
+
+    @staticmethod
+    def peak_rss():
+        """Peak RSS of the runner in KiB since the last reset, None if unknown."""
+        try:
+            with open("/proc/self/status", "r") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1])
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    @classmethod
+    def reset_peak_rss(cls):
+        """Start measuring the peak RSS of a new phase."""
+        peak = cls.peak_rss()
+        if peak is None:
+            return
+        # Phases in progress keep the peak reached until now.
+        cls.peaks = [max(p, peak) for p in cls.peaks]
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        except OSError:
+            pass
+
+    @classmethod
+    @contextlib.contextmanager
+    def phase(cls, name):
+        cls.reset_peak_rss()
+        cls.stack.append(name)
+        cls.peaks.append(0)
+        path = "/".join(cls.stack)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            cls.stack.pop()
+            peak = cls.peak_rss()
+            if peak is not None:
+                peak = max(peak, cls.peaks.pop())
+            else:
+                cls.peaks.pop()
+            cls.phases.append(
+                {
+                    "phase": path,
+                    "start": round(start - cls.origin, 6),
+                    "duration": round(end - start, 6),
+                    # Peak RSS in KiB of the runner during the phase, left
+                    # out without /proc/self/clear_refs (Linux >= 4.0).
+                    "max_rss": peak,
+                    # Peak RSS in KiB of the largest command waited for
+                    # (run.sh, ssh, git...) since the runner started: the
+                    # kernel doesn't reset it.
+                    "children_lifetime_max_rss": resource.getrusage(
+                        resource.RUSAGE_CHILDREN
+                    ).ru_maxrss,
+                }
+            )
+
+    @classmethod
+    def save(cls, output, test_uuid):
+        record = {"test": test_uuid, "phases": cls.phases}
+        with results_lock(output):
+            with open(os.path.join(output, ".timings.jsonl"), "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    @staticmethod
+    def finalize(output):
+        logger = logging.getLogger("RUNNER.Timings")
+        jsonl_path = os.path.join(output, ".timings.jsonl")
+        if not os.path.isfile(jsonl_path):
+            return
+        with results_lock(output):
+            with open(jsonl_path, "r") as f:
+                records = [json.loads(line) for line in f if line.endswith("\n")]
+            with open(os.path.join(output, "timings.json"), "w") as f:
+                json.dump(records, f, indent=4)
+
+        summary = {}
+        for record in records:
+            for phase in record["phases"]:
+                durations, rss = summary.setdefault(phase["phase"], ([], [0]))
+                durations.append(phase["duration"])
+                rss[0] = max(rss[0], phase["max_rss"] or 0)
+        lines = [
+            "%-32s %6s %10s %10s %10s %12s"
+            % ("phase", "count", "total s", "mean s", "max s", "peak RSS KiB")
+        ]
+        for name, (durations, rss) in sorted(
+            summary.items(), key=lambda item: -sum(item[1][0])
+        ):
+            lines.append(
+                "%-32s %6d %10.3f %10.3f %10.3f %12d"
+                % (
+                    name,
+                    len(durations),
+                    sum(durations),
+                    statistics.mean(durations),
+                    max(durations),
+                    rss[0],
+                )
+            )
+        logger.info(
+            "Phase timings saved to: %s\n%s"
+            % (os.path.join(output, "timings.json"), "\n".join(lines))
+        )
+
+
+class RuntimeHistory(object):
+    """
+    Durations of previous runs of each test, used to balance plan shards.
+
+    Tests are identified by their path and parameters. The last KEEP
+    durations of every test are kept in a JSON file which is updated by
+    run_test() after each test. The shards of a plan are computed by
+    separate runs, which must all read the same history to agree on the
+    partition: --shard runs record to <output>/runtimes.json instead, merged
+    into the history with --merge-runtimes once every shard ran.
+    """
+
+    KEEP = 5
+
+    def __init__(self, path):
+        self.path = path
+        self.logger = logging.getLogger("RUNNER.RuntimeHistory")
+
+    @staticmethod
+    def key(test):
+        params = test.get("parameters", test.get("params", {}))
+        return "%s %s" % (test["path"], json.dumps(params, sort_keys=True))
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def update(self, new_durations):
+        """Append {key: [durations]} to the history."""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        with file_lock(self.path + ".lock"):
+            history = self.load()
+            for key, values in new_durations.items():
+                durations = history.setdefault(key, [])
+                durations.extend(values)
+                del durations[: -self.KEEP]
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(history, f, indent=4, sort_keys=True)
+            os.rename(self.path + ".tmp", self.path)
+
+    def record(self, test, duration):
+        self.update({self.key(test): [round(duration, 3)]})
+
+    def merge(self, output):
+        """Add the durations recorded by a --shard run in output."""
+        path = os.path.join(output, "runtimes.json")
+        if not os.path.isfile(path):
+            self.logger.warning("No test durations recorded in %s" % output)
+            return
+        with open(path, "r") as f:
+            self.update(json.load(f))
+        self.logger.info("Merged the test durations of %s" % output)
+
+    def shards(self, test_list, count):
+        """
+        Split test_list into count shards of about the same total runtime.
+
+        Tests are assigned longest first to the shard with the lowest total
+        so far. Tests without history are assumed to take the median of the
+        known durations. Every shard keeps the plan order of its tests.
+        """
+        history = self.load()
+        estimates = []
+        for test in test_list:
+            durations = history.get(self.key(test))
+            estimates.append(statistics.median(durations) if durations else None)
+        known = [estimate for estimate in estimates if estimate is not None]
+        default = statistics.median(known) if known else 1.0
+        estimates = [default if e is None else e for e in estimates]
+
+        totals = [(0.0, index) for index in range(count)]
+        assigned = [[] for index in range(count)]
+        for position in sorted(range(len(test_list)), key=lambda i: (-estimates[i], i)):
+            total, index = heapq.heappop(totals)
+            assigned[index].append(position)
+            heapq.heappush(totals, (total + estimates[position], index))
+
+        for index, positions in enumerate(assigned):
+            self.logger.debug(
+                "Shard %s/%s: %s tests, %.1fs estimated"
+                % (
+                    index + 1,
+                    count,
+                    len(positions),
+                    sum(estimates[p] for p in positions),
+                )
+            )
+        return [[test_list[p] for p in sorted(positions)] for positions in assigned]
+
+
 class TestPlan(object):
     """
     Analysis args specified, then generate test plan.
@@ -88,61 +420,74 @@ class TestPlan(object):
         self.skip_install = args.skip_install
         self.logger = logging.getLogger("RUNNER.TestPlan")
         self.overlay = args.overlay
+        self.shard = args.shard
+        self.runtime_history = args.runtime_history
 
     def apply_overlay(self, test_list):
         fixed_test_list = copy.deepcopy(test_list)
         logger = logging.getLogger("RUNNER.TestPlan.Overlay")
         with open(self.overlay) as f:
-            data = yaml.load(f, Loader=yaml.SafeLoader)
+            data = yaml.load(f, Loader=SafeLoader)
+
+        def index(entries):
+            """Map (path, repository) to the overlay entries, in order."""
+            entries_index = {}
+            for entry in entries:
+                key = (entry["path"], entry["repository"])
+                entries_index.setdefault(key, []).append(entry)
+            return entries_index
 
         if data.get("skip"):
-            skip_tests = data["skip"]
-            for test in test_list:
-                for skip_test in skip_tests:
-                    if (
-                        test["path"] == skip_test["path"]
-                        and test["repository"] == skip_test["repository"]
-                    ):
-                        fixed_test_list.remove(test)
-                        logger.info("Skipped: {}".format(test))
-                    else:
-                        continue
+            skip_index = index(data["skip"])
+            skipped = [
+                test
+                for test in fixed_test_list
+                if (test["path"], test.get("repository")) in skip_index
+            ]
+            for test in skipped:
+                logger.info("Skipped: {}".format(test))
+            fixed_test_list = [
+                test
+                for test in fixed_test_list
+                if (test["path"], test.get("repository")) not in skip_index
+            ]
 
         if data.get("amend"):
-            amend_tests = data["amend"]
+            amend_index = index(data["amend"])
             for test in fixed_test_list:
-                for amend_test in amend_tests:
-                    if (
-                        test["path"] == amend_test["path"]
-                        and test["repository"] == amend_test["repository"]
-                    ):
-                        if amend_test.get("parameters"):
-                            if test.get("parameters"):
-                                test["parameters"].update(amend_test["parameters"])
-                            else:
-                                test["parameters"] = amend_test["parameters"]
-                            logger.info("Updated: {}".format(test))
+                key = (test["path"], test.get("repository"))
+                for amend_test in amend_index.get(key, []):
+                    if amend_test.get("parameters"):
+                        if test.get("parameters"):
+                            test["parameters"].update(amend_test["parameters"])
                         else:
-                            logger.warning(
-                                "'parameters' not found in {}, nothing to amend.".format(
-                                    amend_test
-                                )
+                            test["parameters"] = amend_test["parameters"]
+                        logger.info("Updated: {}".format(test))
+                    else:
+                        logger.warning(
+                            "'parameters' not found in {}, nothing to amend.".format(
+                                amend_test
                             )
+                        )
 
         if data.get("add"):
             add_tests = data["add"]
             unique_add_tests = []
+            add_keys = set()
             for test in add_tests:
-                if test not in unique_add_tests:
+                key = test_key(test)
+                if key not in add_keys:
+                    add_keys.add(key)
                     unique_add_tests.append(test)
                 else:
                     logger.warning("Skipping duplicate test {}".format(test))
 
             for test in test_list:
                 del test["uuid"]
+            plan_keys = set(test_key(test) for test in test_list)
 
             for add_test in unique_add_tests:
-                if add_test in test_list:
+                if test_key(add_test) in plan_keys:
                     logger.warning(
                         "{} already included in test plan, do nothing.".format(add_test)
                     )
@@ -169,7 +514,7 @@ class TestPlan(object):
                 sys.exit(1)
 
             with open(self.test_plan, "r") as f:
-                test_plan = yaml.safe_load(f)
+                test_plan = yaml.load(f, Loader=SafeLoader)
             try:
                 plan_version = test_plan["metadata"].get("format")
                 self.logger.info("Test plan version: {}".format(plan_version))
@@ -188,14 +533,14 @@ class TestPlan(object):
                                     tests.append(test)
 
                 test_list = []
-                unique_tests = []  # List of test hashes
+                unique_tests = set()  # Set of test keys
                 for test in tests:
-                    test_hash = hash(json.dumps(test, sort_keys=True))
-                    if test_hash in unique_tests:
+                    key = test_key(test)
+                    if key in unique_tests:
                         # Test is already in the test_list; don't add it again.
                         self.logger.warning("Skipping duplicate test {}".format(test))
                         continue
-                    unique_tests.append(test_hash)
+                    unique_tests.add(key)
                     test_list.append(test)
                 for test in test_list:
                     test["uuid"] = str(uuid4())
@@ -206,10 +551,165 @@ class TestPlan(object):
             self.logger.error("Please specify a test or test plan.")
             sys.exit(1)
 
-        if self.overlay is None:
-            return test_list
-        else:
-            return self.apply_overlay(test_list)
+        if self.overlay is not None:
+            test_list = self.apply_overlay(test_list)
+
+        if self.shard is not None:
+            test_list = self.apply_shard(test_list)
+        return test_list
+
+    def apply_shard(self, test_list):
+        try:
+            index, count = [int(x) for x in self.shard.split("/")]
+        except ValueError:
+            index, count = 0, 0
+        if count < 1 or not 1 <= index <= count:
+            self.logger.error("Invalid shard %s, expected INDEX/COUNT" % self.shard)
+            sys.exit(1)
+        shards = RuntimeHistory(self.runtime_history).shards(test_list, count)
+        self.logger.info(
+            "Running shard %s: %s of %s tests"
+            % (self.shard, len(shards[index - 1]), len(test_list))
+        )
+        return shards[index - 1]
+
+
+class GitVersion(object):
+    """
+    Resolve the commit checked out in a git repository without running git.
+
+    .git/HEAD and the refs are read directly, falling back to
+    'git rev-parse HEAD' for layouts this doesn't handle (worktrees,
+    submodules, reftable...). Results are cached per repository for the
+    whole run; run_plan() resolves REPO_PATH before tests are forked.
+    """
+
+    heads = {}
+
+    @staticmethod
+    def read_ref(git_dir, ref):
+        try:
+            with open(os.path.join(git_dir, ref), "r") as f:
+                return f.read().strip()
+        except OSError:
+            pass
+        try:
+            with open(os.path.join(git_dir, "packed-refs"), "r") as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[1] == ref:
+                        return fields[0]
+        except OSError:
+            pass
+        return None
+
+    @classmethod
+    def read_head(cls, path):
+        git_dir = os.path.join(path, ".git")
+        if not os.path.isdir(git_dir):
+            return None
+        try:
+            with open(os.path.join(git_dir, "HEAD"), "r") as f:
+                head = f.read().strip()
+        except OSError:
+            return None
+        if head.startswith("ref: "):
+            head = cls.read_ref(git_dir, head[5:])
+        if head and re.match(r"^[0-9a-f]{40}([0-9a-f]{24})?$", head):
+            return head
+        return None
+
+    @classmethod
+    def head(cls, path):
+        path = os.path.realpath(path)
+        if path not in cls.heads:
+            head = cls.read_head(path)
+            if head is None:
+                head = (
+                    subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path)
+                    .decode("utf-8")
+                    .strip()
+                )
+            cls.heads[path] = head
+        return cls.heads[path]
+
+
+def get_repo_path(logger):
+    """Return the test repository set up by bin/setenv.sh, exit if unset."""
+    try:
+        return os.environ["REPO_PATH"]
+    except KeyError:
+        logger.error("KeyError: REPO_PATH")
+        logger.error("Please run '. ./bin/setenv.sh' to setup test environment")
+        sys.exit(1)
+
+
+class RepoSnapshot(object):
+    """
+    Pristine copies of the test repository shared by all tests of a run.
+
+    One snapshot is built per (repository, version) pair under
+    <output>/.snapshots, so every version is checked out once per run.
+    Per-test directories are then materialised from the snapshot with hard
+    links or reflinks instead of a full copy, so only files generated for
+    the test (run.sh, uuid, testdef.yaml, logs and results) are private to
+    it. With the default 'copy' mode only versioned tests use snapshots,
+    which are copied in full.
+
+    Hard links share inodes with the snapshot: a test that modifies a
+    repository file in place modifies it for every test. Use 'reflink' (or
+    the default 'copy') for such tests.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.mode = args.repo_snapshot
+        self.logger = logging.getLogger("RUNNER.RepoSnapshot")
+        self.repo_path = get_repo_path(self.logger)
+        self.snapshot_dir = os.path.join(output_dir(args), ".snapshots")
+
+    def path(self, version=None):
+        repo_id = hashlib.sha1(
+            os.path.realpath(self.repo_path).encode("utf-8")
+        ).hexdigest()[:12]
+        version_id = re.sub(r"[^\w.-]", "_", version) if version else "HEAD"
+        return os.path.join(self.snapshot_dir, "%s-%s" % (repo_id, version_id))
+
+    def create(self, version=None):
+        path = self.path(version)
+        if self.repo_path in path:
+            # copytree() would copy the snapshots into themselves.
+            self.logger.error(
+                "Cannot copy repository into itself. Please choose output directory outside repository path"
+            )
+            sys.exit(1)
+        shutil.rmtree(path, ignore_errors=True)
+        shutil.copytree(self.repo_path, path, symlinks=True)
+        if version:
+            subprocess.call(["git", "checkout", "-q", version], cwd=path)
+        self.logger.info("Repository snapshot created: %s" % path)
+
+    def prepare(self, test_list):
+        """Build one snapshot for every distinct version used in test_list."""
+        versions = []
+        for test in test_list:
+            version = test.get("version", None)
+            if version is None and self.mode == "copy":
+                # Copied straight from REPO_PATH.
+                continue
+            if version not in versions:
+                versions.append(version)
+        for version in versions:
+            self.create(version)
+
+    def materialize(self, version, dest):
+        src = self.path(version)
+        if self.mode == "copy":
+            shutil.copytree(src, dest, symlinks=True)
+        elif self.mode == "hardlink":
+            shutil.copytree(src, dest, symlinks=True, copy_function=os.link)
+        elif self.mode == "reflink":
+            subprocess.check_call(["cp", "-a", "--reflink=auto", src, dest])
 
 
 class TestSetup(object):
@@ -226,14 +726,7 @@ class TestSetup(object):
 
     def validate_env(self):
         # Inspect if environment set properly.
-        try:
-            self.repo_path = os.environ["REPO_PATH"]
-        except KeyError:
-            self.logger.error("KeyError: REPO_PATH")
-            self.logger.error(
-                "Please run '. ./bin/setenv.sh' to setup test environment"
-            )
-            sys.exit(1)
+        self.repo_path = get_repo_path(self.logger)
 
     def create_dir(self):
         if not os.path.exists(self.test["output"]):
@@ -248,16 +741,14 @@ class TestSetup(object):
                 "Cannot copy repository into itself. Please choose output directory outside repository path"
             )
             sys.exit(1)
-        shutil.copytree(self.repo_path, self.test["test_path"], symlinks=True)
+        if self.args.repo_snapshot == "copy" and not self.test_version:
+            shutil.copytree(self.repo_path, self.test["test_path"], symlinks=True)
+        else:
+            RepoSnapshot(self.args).materialize(
+                self.test_version, self.test["test_path"]
+            )
         self.logger.info("Test repo copied to: %s" % self.test["test_path"])
 
-    def checkout_version(self):
-        if self.test_version:
-            path = os.getcwd()
-            os.chdir(self.test["test_path"])
-            subprocess.call("git checkout %s" % self.test_version, shell=True)
-            os.chdir(path)
-
     def create_uuid_file(self):
         with open("%s/uuid" % self.test["test_path"], "w") as f:
             f.write(self.test["uuid"])
@@ -284,12 +775,9 @@ class TestDefinition(object):
         self.exists = False
         if os.path.isfile(self.test["path"]):
             self.exists = True
-            with open(self.test["path"], "r") as f:
-                self.testdef = yaml.safe_load(f)
-                if self.testdef["metadata"]["format"].startswith(
-                    "Manual Test Definition"
-                ):
-                    self.is_manual = True
+            testdef = py_testdef_lib.load(self.test["path"])
+            self.testdef = testdef.data
+            self.is_manual = testdef.is_manual
         if self.is_manual:
             self.runner = ManualTestRun(test, args)
         elif self.args.target is not None:
@@ -343,6 +831,11 @@ class TestDefinition(object):
             os.chmod("%s/run.sh" % self.test["test_path"], 0o755)
 
     def run(self):
+        if not self.is_manual:
+            parse = self.testdef.get("parse", {})
+            self.runner.log_parser = LogParser(
+                parse.get("pattern"), parse.get("fixupdict")
+            )
         self.runner.run()
 
     def handle_parameters(self):
@@ -385,11 +878,164 @@ class TestDefinition(object):
         return ret_val
 
 
+class OutputCapture(object):
+    """
+    Low overhead capture of a test's output.
+
+    The test runs with its stdout and stderr on a pipe. Output is read in
+    large chunks when select() reports data, written as is to stdout.log,
+    split into lines for the LogParser and optionally echoed to the console
+    at a limited rate. The CPU time spent capturing is measured; when it
+    exceeds the configured share of wall time, capture backs off so the
+    enlarged pipe buffer fills up and the next read gets a bigger chunk.
+    """
+
+    CHUNK_SIZE = 256 * 1024
+    PIPE_SIZE = 1024 * 1024
+    # Seconds between two checks of the capture CPU use.
+    CPU_CHECK_INTERVAL = 0.5
+
+    def __init__(self, log_path, log_parser=None, echo=True, echo_rate=None):
+        self.logger = logging.getLogger("RUNNER.OutputCapture")
+        self.log_path = log_path
+        self.log_parser = log_parser
+        self.echo = echo
+        # Console echo limit in bytes per second, None for no limit.
+        self.echo_rate = echo_rate
+        self.echo_budget = echo_rate
+        self.echo_dropped = 0
+        self.partial = ""
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.bytes_read = 0
+        self.cpu_time = 0.0
+
+    def handle(self, data):
+        text = self.decoder.decode(data, final=not data)
+        if self.log_parser is not None:
+            lines = (self.partial + text).split("\n")
+            self.partial = lines.pop()
+            for line in lines:
+                self.log_parser.feed(line + "\n")
+            if not data and self.partial:
+                self.log_parser.feed(self.partial)
+        if self.echo and text:
+            self.echo_text(text)
+
+    def echo_text(self, text):
+        if self.echo_rate is not None:
+            if len(text) > self.echo_budget:
+                self.echo_dropped += len(text) - int(self.echo_budget)
+                text = text[: int(self.echo_budget)]
+            self.echo_budget -= len(text)
+        sys.stdout.write(text)
+        sys.stdout.flush()
+
+    def refill_echo_budget(self, elapsed):
+        if self.echo_rate is None:
+            return
+        self.echo_budget = min(
+            self.echo_rate, self.echo_budget + self.echo_rate * elapsed
+        )
+        if self.echo_dropped and self.echo_budget >= self.echo_rate:
+            sys.stdout.write(
+                "\n[%s bytes of output not shown, see %s]\n"
+                % (self.echo_dropped, self.log_path)
+            )
+            self.echo_dropped = 0
+
+    def run(self, command, timeout=None, cpu_limit=None):
+        """
+        Run command until it exits or timeout seconds pass.
+
+        cpu_limit is the share of wall time, in percent, the capture may use.
+        Return True if the command finished, False if it was killed.
+        """
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
+        fd = process.stdout.fileno()
+        try:
+            fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, self.PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass
+        os.set_blocking(fd, False)
+
+        start = time.monotonic()
+        cpu_start = time.process_time()
+        check_wall, check_cpu = start, cpu_start
+        last = start
+        finished = True
+        with open(self.log_path, "wb") as log:
+            while True:
+                now = time.monotonic()
+                if timeout and now - start > timeout:
+                    finished = False
+                    break
+                wait = 1.0
+                if timeout:
+                    wait = max(0, min(wait, start + timeout - now))
+                ready, _, _ = select.select([fd], [], [], wait)
+                now = time.monotonic()
+                self.refill_echo_budget(now - last)
+                last = now
+                if not ready:
+                    # Background children of the test may keep the pipe open.
+                    if process.poll() is not None:
+                        break
+                    continue
+                try:
+                    data = os.read(fd, self.CHUNK_SIZE)
+                except BlockingIOError:
+                    continue
+                if not data:
+                    break
+                self.bytes_read += len(data)
+                log.write(data)
+                self.handle(data)
+
+                if cpu_limit and now - check_wall >= self.CPU_CHECK_INTERVAL:
+                    cpu = time.process_time()
+                    used = (cpu - check_cpu) / (now - check_wall)
+                    if used > cpu_limit / 100.0:
+                        # Sleep until the average use drops to the limit.
+                        time.sleep(
+                            (cpu - check_cpu) * 100.0 / cpu_limit - (now - check_wall)
+                        )
+                    check_wall, check_cpu = time.monotonic(), time.process_time()
+            self.handle(b"")
+
+        if not finished:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        process.stdout.close()
+        process.wait()
+        wall = time.monotonic() - start
+        self.cpu_time = time.process_time() - cpu_start
+        self.logger.info(
+            "Captured %s bytes of output using %.2f s CPU in %.2f s (%.1f%%)"
+            % (
+                self.bytes_read,
+                self.cpu_time,
+                wall,
+                100.0 * self.cpu_time / wall if wall else 0,
+            )
+        )
+        return finished
+
+
 class TestRun(object):
     def __init__(self, test, args):
         self.test = test
         self.args = args
         self.logger = logging.getLogger("RUNNER.TestRun")
+        # Set by TestDefinition.run() to parse output while the test runs.
+        self.log_parser = None
         self.test_timeout = self.args.timeout
         if "timeout" in test:
             self.test_timeout = test["timeout"]
@@ -402,8 +1048,32 @@ class TestRun(object):
 
 
 class AutomatedTestRun(TestRun):
+    def capture(self, command):
+        """Run command with OutputCapture, writing the test's stdout.log."""
+        if self.test_timeout:
+            self.logger.info("Test timeout: %s" % self.test_timeout)
+        echo_rate = None
+        if self.args.echo_rate is not None:
+            echo_rate = self.args.echo_rate * 1024
+        capture = OutputCapture(
+            "%s/stdout.log" % self.test["test_path"],
+            log_parser=self.log_parser,
+            # Parallel tests only log to their own stdout.log.
+            echo=self.args.jobs <= 1 and echo_rate != 0,
+            echo_rate=echo_rate,
+        )
+        if capture.run(command, self.test_timeout, self.args.capture_cpu_limit):
+            self.logger.info("%s test finished.\n" % self.test["test_uuid"])
+        else:
+            self.logger.warning(
+                "%s test timed out, killed test process" % self.test["test_uuid"]
+            )
+
     def run(self):
         self.logger.info("Executing %s/run.sh" % self.test["test_path"])
+        if self.args.output_capture == "stream":
+            self.capture(["%s/run.sh" % self.test["test_path"]])
+            return
         shell_cmd = "%s/run.sh 2>&1 | tee %s/stdout.log" % (
             self.test["test_path"],
             self.test["test_path"],
@@ -411,30 +1081,177 @@ class AutomatedTestRun(TestRun):
         self.child = pexpect.spawnu("/bin/sh", ["-c", shell_cmd])
         self.check_result()
 
+    def read_line(self, timeout=-1):
+        """Print and parse the next line of output, return False at EOF."""
+        try:
+            self.child.expect("\r\n", timeout=timeout)
+        except pexpect.EOF:
+            if self.log_parser is not None and self.child.before:
+                self.log_parser.feed(self.child.before)
+            return False
+        if self.args.jobs <= 1:
+            # Parallel tests only log to their own stdout.log.
+            print(self.child.before)
+        if self.log_parser is not None:
+            self.log_parser.feed(self.child.before + "\n")
+        return True
+
     def check_result(self):
         if self.test_timeout:
             self.logger.info("Test timeout: %s" % self.test_timeout)
             test_end = time.time() + self.test_timeout
 
-        while self.child.isalive():
+        eof = False
+        while not eof and self.child.isalive():
             if self.test_timeout and time.time() > test_end:
                 self.logger.warning(
                     "%s test timed out, killing test process..."
                     % self.test["test_uuid"]
                 )
                 self.child.terminate(force=True)
-                break
+                return
             try:
-                self.child.expect("\r\n")
-                print(self.child.before)
+                eof = not self.read_line()
             except pexpect.TIMEOUT:
                 continue
-            except pexpect.EOF:
-                self.logger.info("%s test finished.\n" % self.test["test_uuid"])
-                break
+        # The output of a test that just exited may still be in the pty
+        # buffer. Background processes keeping the pty open are not waited
+        # for.
+        try:
+            while not eof:
+                eof = not self.read_line(timeout=1)
+        except pexpect.TIMEOUT:
+            pass
+        self.logger.info("%s test finished.\n" % self.test["test_uuid"])
+
+
+# Helper executed on the target by RemoteTestRun.sync_to_target().
+# Usage: sh target-sync.sh missing|install CACHE_DIR MANIFEST
+# The manifest has one "<sha1> <mode> <path>" or "link <dest> <path>" line
+# per file. Objects are unpacked to a temporary directory first and renamed
+# into the cache, so concurrent tests never see partially written objects.
+TARGET_SYNC_SCRIPT = """\
+set -e
+cache="$2"
+manifest="$3"
+case "$1" in
+missing)
+    while read -r hash mode path; do
+        [ "$hash" = link ] && continue
+        [ -f "$cache/objects/$hash" ] || echo "$hash"
+    done < "$manifest"
+    ;;
+install)
+    if [ -f target-sync-objects.tar ]; then
+        tmp="$cache/tmp.$$"
+        mkdir -p "$tmp"
+        tar -xf target-sync-objects.tar -C "$tmp"
+        for object in "$tmp"/*; do
+            mv -f "$object" "$cache/objects/"
+        done
+        rm -rf "$tmp" target-sync-objects.tar
+    fi
+    while read -r hash mode path; do
+        mkdir -p "$(dirname "$path")"
+        if [ "$hash" = link ]; then
+            ln -sf "$mode" "$path"
+        else
+            cp "$cache/objects/$hash" "$path"
+            chmod "$mode" "$path"
+        fi
+    done < "$manifest"
+    ;;
+esac
+"""
 
 
 class RemoteTestRun(AutomatedTestRun):
+    def test_files(self):
+        """Return files copied to the target, relative to the test path."""
+        files = ["run.sh", "uuid"]
+        for top in [
+            "automated/lib",
+            "automated/bin",
+            "automated/utils",
+            self.test["tc_relative_dir"],
+        ]:
+            for root, dirs, filenames in os.walk(top):
+                dirs.sort()
+                # Symbolic links to directories are recreated, not followed.
+                links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+                for name in sorted(filenames + links):
+                    files.append(os.path.join(root, name))
+        return files
+
+    def build_manifest(self):
+        """Return (manifest lines, {sha1: path}) for the test files."""
+        lines = []
+        objects = {}
+        for path in self.test_files():
+            if os.path.islink(path):
+                lines.append("link %s %s" % (os.readlink(path), path))
+                continue
+            sha1 = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha1.update(chunk)
+            digest = sha1.hexdigest()
+            objects.setdefault(digest, path)
+            lines.append("%s %o %s" % (digest, os.stat(path).st_mode & 0o7777, path))
+        return lines, objects
+
+    def sync_to_target(self):
+        """
+        Copy test files through a content-addressed cache on the target.
+
+        Only files whose content is not yet in the target cache
+        (~/.cache/test-runner/objects) are sent. The shared lib, bin and
+        utils trees are therefore copied once and reused by later tests
+        and runs.
+        """
+        os.chdir(self.test["test_path"])
+        cache = self.test["target_cache_path"]
+        target_path = self.test["target_test_path"]
+
+        lines, objects = self.build_manifest()
+        with open("target-sync.manifest", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        with open("target-sync.sh", "w") as f:
+            f.write(TARGET_SYNC_SCRIPT)
+
+        self.logger.info("Sending file manifest to target")
+        run_command("mkdir -p %s/objects %s" % (cache, target_path), self.args.target)
+        run_command(
+            "scp %s ./target-sync.manifest ./target-sync.sh %s:%s"
+            % (SSHMultiplexer.params(), self.args.target, target_path)
+        )
+        missing = set(
+            run_command(
+                "cd %s && sh target-sync.sh missing %s target-sync.manifest"
+                % (target_path, cache),
+                self.args.target,
+            ).split()
+        )
+        self.logger.info(
+            "Target cache is missing %s of %s files" % (len(missing), len(objects))
+        )
+
+        if missing:
+            with tarfile.open("target-sync-objects.tar", "w") as tar:
+                for digest in sorted(missing):
+                    tar.add(objects[digest], arcname=digest)
+            run_command(
+                "scp %s ./target-sync-objects.tar %s:%s"
+                % (SSHMultiplexer.params(), self.args.target, target_path)
+            )
+
+        self.logger.info("Installing test files from target cache")
+        run_command(
+            "cd %s && sh target-sync.sh install %s target-sync.manifest"
+            % (target_path, cache),
+            self.args.target,
+        )
+
     def copy_to_target(self):
         os.chdir(self.test["test_path"])
         tarball_name = "target-test-files.tar"
@@ -452,7 +1269,7 @@ class RemoteTestRun(AutomatedTestRun):
         run_command(
             "scp %s ./%s %s:%s"
             % (
-                SSH_PARAMS,
+                SSHMultiplexer.params(),
                 tarball_name,
                 self.args.target,
                 self.test["target_test_path"],
@@ -475,22 +1292,32 @@ class RemoteTestRun(AutomatedTestRun):
         run_command("rm -rf %s" % (self.test["target_test_path"]), self.args.target)
 
     def run(self):
-        self.copy_to_target()
+        with Timings.phase("copy_to_target"):
+            if self.args.target_sync == "incremental":
+                self.sync_to_target()
+            else:
+                self.copy_to_target()
         self.logger.info(
             "Executing %s/run.sh remotely on %s"
             % (self.test["target_test_path"], self.args.target)
         )
         shell_cmd = 'ssh %s %s "%s/run.sh 2>&1"' % (
-            SSH_PARAMS,
+            SSHMultiplexer.params(),
             self.args.target,
             self.test["target_test_path"],
         )
         self.logger.debug("shell_cmd: %s" % shell_cmd)
+        if self.args.output_capture == "stream":
+            self.capture(shlex.split(shell_cmd))
+            with Timings.phase("cleanup_target"):
+                self.cleanup_target()
+            return
         output = open("%s/stdout.log" % self.test["test_path"], "w")
         self.child = pexpect.spawnu(shell_cmd)
         self.child.logfile = output
         self.check_result()
-        self.cleanup_target()
+        with Timings.phase("cleanup_target"):
+            self.cleanup_target()
 
 
 class ManualTestShell(cmd.Cmd):
@@ -606,8 +1433,9 @@ class ManualTestShell(cmd.Cmd):
 class ManualTestRun(TestRun, cmd.Cmd):
     def run(self):
         print(self.test["test_name"])
-        with open("%s/testdef.yaml" % self.test["test_path"], "r") as f:
-            self.testdef = yaml.safe_load(f)
+        self.testdef = py_testdef_lib.load(
+            "%s/testdef.yaml" % self.test["test_path"]
+        ).data
 
         if "name" in self.test:
             test_case_id = self.test["name"]
@@ -620,6 +1448,224 @@ class ManualTestRun(TestRun, cmd.Cmd):
         pass
 
 
+# Shell sampler started by ResourceSampler, locally or on the target.
+# Usage: sh -s INTERVAL < script
+# Prints one block per sample, starting with "@ <uptime>". Only shell
+# builtins are used to read /proc and /sys, so a sample costs one fork (sleep).
+RESOURCE_SAMPLER_SCRIPT = """\
+interval="$1"
+while :; do
+    read -r uptime idle < /proc/uptime
+    echo "@ $uptime"
+    while read -r name v1 v2 v3 v4 v5 v6 v7 v8 rest; do
+        case "$name" in
+        cpu*) echo "$name $v1 $v2 $v3 $v4 $v5 $v6 $v7 $v8" ;;
+        intr) echo "intr $v1" ;;
+        esac
+    done < /proc/stat
+    while read -r name value rest; do
+        case "$name" in
+        MemTotal:|MemAvailable:) echo "$name $value" ;;
+        esac
+    done < /proc/meminfo
+    line="freq"
+    for f in /sys/devices/system/cpu/cpu[0-9]*/cpufreq/scaling_cur_freq; do
+        [ -r "$f" ] && read -r value < "$f" && line="$line $value"
+    done
+    echo "$line"
+    line="temp"
+    for f in /sys/class/thermal/thermal_zone*/temp; do
+        [ -r "$f" ] && read -r value < "$f" && line="$line $value"
+    done
+    echo "$line"
+    line="throttle"
+    for f in /sys/devices/system/cpu/cpu[0-9]*/thermal_throttle/core_throttle_count; do
+        [ -r "$f" ] && read -r value < "$f" && line="$line $value"
+    done
+    echo "$line"
+    sleep "$interval"
+done
+"""
+
+
+class ResourceSampler(object):
+    """
+    Sample system resource usage while a test runs.
+
+    RESOURCE_SAMPLER_SCRIPT is run on the system under test (the local host
+    or --target) every --sample-interval seconds. When the test is done the
+    samples are converted to a compact time series in resources.json, next
+    to stdout.log, together with a summary. ResultParser adds the summary to
+    the test's metrics.
+    """
+
+    def __init__(self, test, args):
+        self.test = test
+        self.args = args
+        self.interval = args.sample_interval
+        self.logger = logging.getLogger("RUNNER.ResourceSampler")
+        self.raw_path = os.path.join(test["test_path"], "resources.raw")
+        self.json_path = os.path.join(test["test_path"], "resources.json")
+        self.process = None
+
+    def start(self):
+        command = ["sh", "-s", str(self.interval)]
+        if self.args.target:
+            command = (
+                ["ssh"]
+                + shlex.split(SSHMultiplexer.params())
+                + [self.args.target, "sh -s %s" % self.interval]
+            )
+        self.logger.info("Sampling resource usage every %s s" % self.interval)
+        with open(self.raw_path, "w") as raw:
+            self.process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=raw,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+                start_new_session=True,
+            )
+        self.process.stdin.write(RESOURCE_SAMPLER_SCRIPT)
+        self.process.stdin.close()
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.terminate()
+        self.process.wait()
+        self.process = None
+        try:
+            series = self.series(self.samples())
+        except (OSError, ValueError, IndexError, KeyError) as e:
+            self.logger.warning("Unable to parse resource samples: %s" % e)
+            return
+        with open(self.json_path, "w") as f:
+            json.dump(series, f)
+        os.remove(self.raw_path)
+
+    def samples(self):
+        """Yield one dict per complete sample of the raw sampler output."""
+        sample = None
+        with open(self.raw_path, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # Sample interrupted when the sampler was stopped.
+                    break
+                fields = line.split()
+                if not fields:
+                    continue
+                if fields[0] == "@":
+                    sample = {"uptime": float(fields[1]), "cpu": {}}
+                elif sample is None:
+                    continue
+                elif fields[0].startswith("cpu"):
+                    sample["cpu"][fields[0]] = [int(v) for v in fields[1:]]
+                elif fields[0] in ("intr", "freq", "temp", "throttle"):
+                    sample[fields[0]] = [int(v) for v in fields[1:]]
+                elif fields[0] in ("MemTotal:", "MemAvailable:"):
+                    sample[fields[0][:-1]] = int(fields[1])
+                if fields[0] == "throttle":
+                    # Last line of a sample.
+                    yield sample
+                    sample = None
+
+    @staticmethod
+    def utilisation(previous, current):
+        """CPU utilisation in percent between two /proc/stat cpu lines."""
+        # Fields: user nice system idle iowait irq softirq steal
+        total = sum(current) - sum(previous)
+        idle = (current[3] + current[4]) - (previous[3] + previous[4])
+        if total <= 0:
+            return 0.0
+        return round(100.0 * (total - idle) / total, 1)
+
+    def series(self, samples):
+        samples = list(samples)
+        series = {
+            "interval": self.interval,
+            "time": [],
+            "cpu_util": [],
+            "core_util": [],
+            "cpu_freq_mhz": [],
+            "mem_used_mb": [],
+            "temp_c": [],
+            "irq_per_s": [],
+            "throttle_events": [],
+        }
+        for previous, sample in zip(samples, samples[1:]):
+            elapsed = sample["uptime"] - previous["uptime"]
+            cores = sorted(
+                (c for c in sample["cpu"] if c != "cpu"), key=lambda c: int(c[3:])
+            )
+            series["time"].append(round(sample["uptime"] - samples[0]["uptime"], 2))
+            # Values the system doesn't expose, e.g. /proc/stat in some
+            # containers, are None and left out of the summary.
+            series["cpu_util"].append(
+                self.utilisation(previous["cpu"]["cpu"], sample["cpu"]["cpu"])
+                if "cpu" in previous["cpu"] and "cpu" in sample["cpu"]
+                else None
+            )
+            series["core_util"].append(
+                [
+                    self.utilisation(
+                        previous["cpu"].get(c, sample["cpu"][c]), sample["cpu"][c]
+                    )
+                    for c in cores
+                ]
+            )
+            series["cpu_freq_mhz"].append([v // 1000 for v in sample.get("freq", [])])
+            series["mem_used_mb"].append(
+                (sample["MemTotal"] - sample["MemAvailable"]) // 1024
+                if "MemTotal" in sample and "MemAvailable" in sample
+                else None
+            )
+            series["temp_c"].append(
+                [round(v / 1000.0, 1) for v in sample.get("temp", [])]
+            )
+            if not (sample.get("intr") and previous.get("intr")):
+                series["irq_per_s"].append(None)
+            elif elapsed > 0:
+                series["irq_per_s"].append(
+                    round((sample["intr"][0] - previous["intr"][0]) / elapsed)
+                )
+            else:
+                series["irq_per_s"].append(0)
+            series["throttle_events"].append(
+                sum(sample.get("throttle", [])) - sum(previous.get("throttle", []))
+            )
+        series["summary"] = self.summary(series)
+        return series
+
+    @staticmethod
+    def summary(series):
+        """Return [(name, value, units)] summarising the time series."""
+        summary = []
+        if not series["time"]:
+            return summary
+        cpu_util = [v for v in series["cpu_util"] if v is not None]
+        if cpu_util:
+            summary.append(["cpu-util-mean", round(statistics.mean(cpu_util), 1), "%"])
+            summary.append(["cpu-util-max", max(cpu_util), "%"])
+        freqs = [f for sample in series["cpu_freq_mhz"] for f in sample]
+        if freqs:
+            summary.append(["cpu-freq-mean", round(statistics.mean(freqs)), "MHz"])
+            summary.append(["cpu-freq-min", min(freqs), "MHz"])
+        mem_used = [v for v in series["mem_used_mb"] if v is not None]
+        if mem_used:
+            summary.append(["mem-used-max", max(mem_used), "MB"])
+        temps = [t for sample in series["temp_c"] for t in sample]
+        if temps:
+            summary.append(["temp-max", max(temps), "C"])
+        irq_rates = [v for v in series["irq_per_s"] if v is not None]
+        if irq_rates:
+            summary.append(
+                ["irq-rate-mean", round(statistics.mean(irq_rates)), "irq/s"]
+            )
+        summary.append(["throttle-events", sum(series["throttle_events"]), "events"])
+        return summary
+
+
 def get_packages(linux_distribution, target=None):
     """Return a list of installed packages with versions
 
@@ -771,92 +1817,532 @@ def get_environment(target=None, skip_collection=False):
     return environment
 
 
-class ResultParser(object):
-    def __init__(self, test, args):
-        self.test = test
+class EnvironmentCache(object):
+    """
+    Environment of the target, collected once per run.
+
+    The environment is stored in <output>/environment.json and shared by all
+    tests of the run, including tests running in parallel worker processes.
+    Tests marked with 'changes_environment: true' in the test plan collect
+    it again after they finish, and later tests use the refreshed copy.
+
+    With '--environment-packages reference' the package list is written once
+    to <output>/packages-<hash>.json and each result only carries the name
+    of that file in 'packages_file'.
+    """
+
+    def __init__(self, args):
         self.args = args
-        self.metrics = []
-        self.results = {}
-        self.results["test"] = test["test_name"]
-        self.results["id"] = test["test_uuid"]
-        self.results["test_plan"] = args.test_plan
-        self.results["environment"] = get_environment(
+        self.logger = logging.getLogger("RUNNER.EnvironmentCache")
+        self.output = output_dir(args)
+        self.path = os.path.join(self.output, "environment.json")
+
+    def collect(self):
+        environment = get_environment(
             target=self.args.target, skip_collection=self.args.skip_environment
         )
-        self.logger = logging.getLogger("RUNNER.ResultParser")
-        self.results["params"] = {}
-        self.pattern = None
-        self.fixup = None
-        self.qa_reports_server = args.qa_reports_server
-        if args.qa_reports_token is not None:
-            self.qa_reports_token = args.qa_reports_token
-        else:
-            self.qa_reports_token = os.environ.get(
-                "QA_REPORTS_TOKEN", get_token_from_netrc(self.qa_reports_server)
-            )
-        self.qa_reports_project = args.qa_reports_project
-        self.qa_reports_group = args.qa_reports_group
-        self.qa_reports_env = args.qa_reports_env
-        self.qa_reports_build_version = args.qa_reports_build_version
-        self.qa_reports_disable_metadata = args.qa_reports_disable_metadata
-        self.qa_reports_metadata = args.qa_reports_metadata
-        self.qa_reports_metadata_file = args.qa_reports_metadata_file
+        if not os.path.exists(self.output):
+            os.makedirs(self.output)
+        with open(self.path, "w") as f:
+            json.dump(environment, f, indent=4)
+        self.logger.info("Environment collected: %s" % self.path)
+        return environment
 
-        with open(os.path.join(self.test["test_path"], "testdef.yaml"), "r") as f:
-            self.testdef = yaml.safe_load(f)
-            self.results["name"] = ""
-            if (
-                "metadata" in self.testdef.keys()
-                and "name" in self.testdef["metadata"].keys()
-            ):
-                self.results["name"] = self.testdef["metadata"]["name"]
-            if "params" in self.testdef.keys():
-                self.results["params"] = self.testdef["params"]
-            if self.args.test_def_params:
-                for param_name, param_value in self.args.test_def_params.items():
-                    self.results["params"][param_name] = param_value
-            if (
-                "parse" in self.testdef.keys()
-                and "pattern" in self.testdef["parse"].keys()
-            ):
-                self.pattern = self.testdef["parse"]["pattern"]
-                self.logger.info("Enabling log parse pattern: %s" % self.pattern)
-                if "fixupdict" in self.testdef["parse"].keys():
-                    self.fixup = self.testdef["parse"]["fixupdict"]
-                    self.logger.info(
-                        "Enabling log parse pattern fixup: %s" % self.fixup
-                    )
-        if "parameters" in test.keys():
-            self.results["params"].update(test["parameters"])
-        if "params" in test.keys():
-            self.results["params"].update(test["params"])
-        if "version" in test.keys():
-            self.results["version"] = test["version"]
-        else:
-            path = os.getcwd()
-            os.chdir(self.test["test_path"])
-            if sys.version_info[0] < 3:
-                test_version = subprocess.check_output("git rev-parse HEAD", shell=True)
+    def get(self, refresh=False):
+        if self.args.skip_environment:
+            return {}
+        with file_lock(os.path.join(self.output, ".environment.lock")):
+            if refresh or not os.path.isfile(self.path):
+                environment = self.collect()
             else:
-                test_version = subprocess.check_output(
-                    "git rev-parse HEAD", shell=True
-                ).decode("utf-8")
-            self.results["version"] = test_version.rstrip()
-            os.chdir(path)
-        self.lava_run = args.lava_run
-        if self.lava_run and not find_executable("lava-test-case"):
-            self.logger.info(
-                "lava-test-case not found, '-l' or '--lava_run' option ignored'"
-            )
-            self.lava_run = False
+                with open(self.path, "r") as f:
+                    environment = json.load(f)
+            if self.args.environment_packages == "reference":
+                environment = self.reference_packages(environment)
+        return environment
 
-    def run(self):
-        self.parse_stdout()
-        if self.pattern:
-            self.parse_pattern()
-        # If 'metrics' is empty, add 'no-result-found fail'.
-        if not self.metrics:
-            self.metrics = [
+    def reference_packages(self, environment):
+        packages = environment.pop("packages", [])
+        content = json.dumps(packages, indent=4)
+        name = "packages-%s.json" % (
+            hashlib.sha1(content.encode("utf-8")).hexdigest()[:12]
+        )
+        path = os.path.join(self.output, name)
+        if not os.path.isfile(path):
+            with open(path, "w") as f:
+                f.write(content)
+        environment["packages_file"] = name
+        return environment
+
+
+class LogParser(object):
+    """
+    Single pass parser of test output.
+
+    Lines are fed one at a time, either while the test is running or from
+    stdout.log afterwards. Both the built-in TEST_CASE_ID= result lines and
+    the test definition's parse pattern are matched, and only the parsed
+    results are kept in memory.
+    """
+
+    SIGNAL_KEYS = {
+        "TEST_CASE_ID": "test_case_id",
+        "RESULT": "result",
+        "MEASUREMENT": "measurement",
+        "UNITS": "units",
+    }
+
+    def __init__(self, pattern=None, fixup=None):
+        self.signal_re = re.compile(r"<(|LAVA_SIGNAL_TESTCASE )TEST_CASE_ID=")
+        self.pattern_re = None
+        if pattern:
+            self.pattern_re = re.compile(r"%s" % pattern)
+        self.fixup = fixup
+        self.signal_metrics = []
+        self.pattern_metrics = []
+
+    def feed(self, line):
+        if "TEST_CASE_ID=" in line and self.signal_re.match(line):
+            self.signal_metrics.append(self.parse_signal(line))
+        if self.pattern_re is not None:
+            m = self.pattern_re.search(line)
+            if m:
+                data = m.groupdict()
+                for x in ["measurement", "units"]:
+                    if x not in data:
+                        data[x] = ""
+                if self.fixup and data["result"] in self.fixup:
+                    data["result"] = self.fixup[data["result"]]
+                self.pattern_metrics.append(data)
+
+    def parse_signal(self, line):
+        data = {
+            "test_case_id": "",
+            "result": "",
+            "measurement": "",
+            "units": "",
+        }
+        for string in line.strip("\n").strip("\r").strip("<>").split(" "):
+            key, sep, value = string.partition("=")
+            if not sep or key not in self.SIGNAL_KEYS:
+                continue
+            if key == "MEASUREMENT":
+                try:
+                    data["measurement"] = float(value)
+                except ValueError:
+                    pass
+            else:
+                data[self.SIGNAL_KEYS[key]] = value
+        return data
+
+    def parse_file(self, path):
+        with open(path, "r") as f:
+            for line in f:
+                self.feed(line)
+
+    def metrics(self):
+        return self.signal_metrics + self.pattern_metrics
+
+
+class LavaReporter(object):
+    """
+    Report results to LAVA.
+
+    'test-case' mode calls lava-test-case once per result. 'signal' mode
+    prints the <LAVA_SIGNAL_TESTCASE ...> lines lava-test-case would print,
+    several at a time. Each write is kept within PIPE_BUF so that lines from
+    tests running in parallel are never interleaved.
+    """
+
+    def __init__(self, mode="test-case"):
+        self.mode = mode
+        self.logger = logging.getLogger("RUNNER.LavaReporter")
+        self.pending = []
+        self.pending_size = 0
+        self.count = 0
+        self.elapsed = 0.0
+
+    def add(self, data):
+        start = time.monotonic()
+        self.count += 1
+        if self.mode == "signal":
+            line = self.signal(data)
+            if self.pending_size + len(line) > select.PIPE_BUF:
+                self.flush()
+            self.pending.append(line)
+            self.pending_size += len(line)
+        else:
+            self.test_case(data)
+        self.elapsed += time.monotonic() - start
+
+    def signal(self, data):
+        line = "<LAVA_SIGNAL_TESTCASE TEST_CASE_ID={} RESULT={}".format(
+            data["test_case_id"], data["result"]
+        )
+        if data["measurement"]:
+            line = "{} MEASUREMENT={}".format(line, data["measurement"])
+            if data["units"]:
+                line = "{} UNITS={}".format(line, data["units"])
+        return (line + ">\n").encode("utf-8")
+
+    def test_case(self, data):
+        cmd = "lava-test-case {} --result {}".format(
+            data["test_case_id"], data["result"]
+        )
+        if data["measurement"]:
+            cmd = "{} --measurement {} --units {}".format(
+                cmd, data["measurement"], data["units"]
+            )
+        self.logger.debug("lava-run: cmd: {}".format(cmd))
+        subprocess.call(shlex.split(cmd))
+
+    def flush(self):
+        if not self.pending:
+            return
+        sys.stdout.flush()
+        os.write(sys.stdout.fileno(), b"".join(self.pending))
+        self.pending = []
+        self.pending_size = 0
+
+    def close(self):
+        start = time.monotonic()
+        self.flush()
+        self.elapsed += time.monotonic() - start
+        self.logger.info(
+            "Reported %s results to LAVA in %.3fs" % (self.count, self.elapsed)
+        )
+
+
+class RepeatStatistics(object):
+    """
+    Combine the metrics of the measured runs of a test run with --repeat.
+
+    Every test case is reported once: it passes only if it passed in every
+    run and its measurement is the median of the runs. As with the APK
+    benchmarks' statistics_result(), statistics are reported as extra
+    metrics, '<test case>-ci-low', '-ci-high' (95% confidence interval of
+    the median), '-cv' (coefficient of variation, in percent) and
+    '-outliers' (runs outside the 1.5 IQR fences). Per run values and
+    outlier flags are kept in the 'repeats' entry of result.json.
+    """
+
+    # Two-sided 95% normal quantile.
+    Z = 1.96
+
+    def __init__(self, warmup=0):
+        self.warmup = warmup
+        self.runs = []
+
+    def add(self, metrics):
+        self.runs.append(metrics)
+
+    @staticmethod
+    def to_float(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def test_cases(self):
+        """Return {test_case_id: [metric of each run]}, in first seen order."""
+        test_cases = {}
+        for metrics in self.runs:
+            for metric in metrics:
+                test_cases.setdefault(metric["test_case_id"], []).append(metric)
+        return test_cases
+
+    @classmethod
+    def median_ci(cls, values):
+        """Distribution free confidence interval of the median."""
+        values = sorted(values)
+        n = len(values)
+        low = int(math.floor(n / 2.0 - cls.Z * math.sqrt(n) / 2.0))
+        high = int(math.ceil(1 + n / 2.0 + cls.Z * math.sqrt(n) / 2.0))
+        return values[max(low, 1) - 1], values[min(high, n) - 1]
+
+    @staticmethod
+    def outliers(values):
+        """Return a flag per value, set for values outside the IQR fences."""
+        if len(values) < 4:
+            return [False] * len(values)
+        q1, q2, q3 = statistics.quantiles(values, n=4)
+        iqr = q3 - q1
+        return [v < q1 - 1.5 * iqr or v > q3 + 1.5 * iqr for v in values]
+
+    def analyse(self):
+        """Return {test_case_id: statistics} over the measured runs."""
+        analysis = {}
+        for test_case_id, metrics in self.test_cases().items():
+            entry = {
+                "results": [m["result"] for m in metrics],
+                "units": metrics[0]["units"],
+            }
+            values = [self.to_float(m["measurement"]) for m in metrics]
+            if all(v is not None for v in values):
+                mean = statistics.mean(values)
+                entry["measurements"] = values
+                entry["median"] = round(statistics.median(values), 6)
+                entry["ci"] = list(self.median_ci(values))
+                entry["cv"] = None
+                if len(values) > 1 and mean:
+                    entry["cv"] = round(100.0 * statistics.stdev(values) / abs(mean), 3)
+                entry["outliers"] = self.outliers(values)
+            analysis[test_case_id] = entry
+        return analysis
+
+    def metrics(self):
+        metrics = []
+        for test_case_id, entry in self.analyse().items():
+            results = entry["results"]
+            if len(results) < len(self.runs) or "fail" in results:
+                # Missing from a run or failed in any run.
+                result = "fail"
+            elif all(r == "pass" for r in results):
+                result = "pass"
+            else:
+                result = results[-1]
+            units = entry["units"]
+            if "median" not in entry:
+                metrics.append(
+                    {
+                        "test_case_id": test_case_id,
+                        "result": result,
+                        "measurement": "",
+                        "units": units,
+                    }
+                )
+                continue
+            for suffix, value, unit in [
+                ("", entry["median"], units),
+                ("-ci-low", entry["ci"][0], units),
+                ("-ci-high", entry["ci"][1], units),
+                ("-cv", entry["cv"], "%"),
+                ("-outliers", sum(entry["outliers"]), "runs"),
+            ]:
+                if value is None:
+                    continue
+                metrics.append(
+                    {
+                        "test_case_id": test_case_id + suffix,
+                        "result": result if not suffix else "pass",
+                        "measurement": value,
+                        "units": unit,
+                    }
+                )
+        return metrics
+
+    def summary(self):
+        return {
+            "runs": len(self.runs),
+            "warmup": self.warmup,
+            "test_cases": self.analyse(),
+        }
+
+
+class BaselineStore(object):
+    """
+    History of test measurements, used to detect performance regressions.
+
+    Measurements are kept in an SQLite database, keyed by test name, test
+    parameters, test_case_id, board and kernel. A new measurement is compared
+    with the median of the last WINDOW ones for the same key. It is a
+    regression when it is worse than the median by more than the threshold
+    and its robust z-score, based on the median absolute deviation, exceeds
+    Z_LIMIT. Measurements in time units are better when lower, all others
+    when higher.
+    """
+
+    WINDOW = 20
+    MIN_HISTORY = 3
+    Z_LIMIT = 3.5
+    # Scale the MAD to the standard deviation of normally distributed values.
+    MAD_SCALE = 1.4826
+    LOWER_IS_BETTER = ["s", "sec", "seconds", "ms", "msec", "us", "usec", "ns", "nsec"]
+    # Metrics derived by test-runner itself are not compared.
+    DERIVED = ("-ci-low", "-ci-high", "-cv", "-outliers", "-regression")
+
+    def __init__(self, path, threshold=5.0, window=WINDOW):
+        self.logger = logging.getLogger("RUNNER.BaselineStore")
+        self.path = path
+        self.threshold = threshold
+        self.window = window
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # Parallel tests share the database, wait for each other's writes.
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS measurements ("
+            "test TEXT, params TEXT, test_case_id TEXT, board TEXT, kernel TEXT, "
+            "measurement REAL, units TEXT, test_uuid TEXT, time REAL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS measurements_key ON measurements "
+            "(test, params, test_case_id, board, kernel, time)"
+        )
+        self.db.commit()
+
+    @staticmethod
+    def board(environment):
+        board = " ".join(
+            environment.get(k, "") for k in ["board_vendor", "board_name"]
+        ).strip()
+        return board or "unknown"
+
+    def history(self, key):
+        rows = self.db.execute(
+            "SELECT measurement FROM measurements WHERE test=? AND params=? AND "
+            "test_case_id=? AND board=? AND kernel=? ORDER BY time DESC LIMIT ?",
+            key + (self.window,),
+        )
+        return [row[0] for row in rows]
+
+    def regression(self, value, history, units):
+        """Return the change in percent if value regressed, None otherwise."""
+        if len(history) < self.MIN_HISTORY:
+            return None
+        median = statistics.median(history)
+        if median == 0:
+            return None
+        change = 100.0 * (value - median) / abs(median)
+        loss = change if units in self.LOWER_IS_BETTER else -change
+        if loss <= self.threshold:
+            return None
+        mad = statistics.median([abs(v - median) for v in history])
+        if mad and abs(value - median) / (self.MAD_SCALE * mad) <= self.Z_LIMIT:
+            return None
+        return round(change, 2)
+
+    def check(self, results):
+        """Record the measurements in results, return regressions as metrics."""
+        environment = results.get("environment", {})
+        board = self.board(environment)
+        kernel = environment.get("kernel", "unknown")
+        params = json.dumps(results.get("params", {}), sort_keys=True)
+        regressions = []
+        rows = []
+        for metric in results["metrics"]:
+            test_case_id = metric["test_case_id"]
+            if metric["result"] != "pass" or test_case_id.startswith("resource-"):
+                continue
+            if test_case_id.endswith(self.DERIVED):
+                continue
+            try:
+                value = float(metric["measurement"])
+            except (TypeError, ValueError):
+                continue
+            key = (results["name"], params, test_case_id, board, kernel)
+            change = self.regression(value, self.history(key), metric["units"])
+            if change is not None:
+                self.logger.warning(
+                    "%s: %s regressed, %s%% from the baseline median"
+                    % (results["name"], test_case_id, change)
+                )
+                regressions.append(
+                    {
+                        "test_case_id": "%s-regression" % test_case_id,
+                        "result": "fail",
+                        "measurement": change,
+                        "units": "%",
+                    }
+                )
+            rows.append(key + (value, metric["units"], results["id"], time.time()))
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        return regressions
+
+    def close(self):
+        self.db.close()
+
+
+class ResultParser(object):
+    CSV_FIELDS = [
+        "name",
+        "test_case_id",
+        "result",
+        "measurement",
+        "units",
+        "test_params",
+    ]
+
+    def __init__(self, test, args, log_parser=None, repeats=None):
+        self.test = test
+        self.args = args
+        self.metrics = []
+        self.results = {}
+        self.results["test"] = test["test_name"]
+        self.results["id"] = test["test_uuid"]
+        self.results["test_plan"] = args.test_plan
+        with Timings.phase("environment"):
+            self.results["environment"] = EnvironmentCache(args).get(
+                refresh=test.get("changes_environment", False)
+            )
+        self.logger = logging.getLogger("RUNNER.ResultParser")
+        self.log_parser = log_parser
+        self.repeats = repeats
+        self.results["params"] = {}
+        self.pattern = None
+        self.fixup = None
+        self.qa_reports_server = args.qa_reports_server
+        self.qa_reports_token = get_qa_reports_token(args)
+        self.qa_reports_project = args.qa_reports_project
+        self.qa_reports_group = args.qa_reports_group
+        self.qa_reports_env = args.qa_reports_env
+        self.qa_reports_build_version = args.qa_reports_build_version
+        self.qa_reports_disable_metadata = args.qa_reports_disable_metadata
+        self.qa_reports_metadata = args.qa_reports_metadata
+        self.qa_reports_metadata_file = args.qa_reports_metadata_file
+
+        testdef = py_testdef_lib.load(
+            os.path.join(self.test["test_path"], "testdef.yaml")
+        )
+        self.testdef = testdef.data
+        self.results["name"] = testdef.name or ""
+        self.results["params"] = testdef.params
+        if self.args.test_def_params:
+            for param_name, param_value in self.args.test_def_params.items():
+                self.results["params"][param_name] = param_value
+        if testdef.parse_pattern:
+            self.pattern = testdef.parse_pattern
+            self.logger.info("Enabling log parse pattern: %s" % self.pattern)
+            if testdef.fixupdict:
+                self.fixup = testdef.fixupdict
+                self.logger.info("Enabling log parse pattern fixup: %s" % self.fixup)
+        if "parameters" in test.keys():
+            self.results["params"].update(test["parameters"])
+        if "params" in test.keys():
+            self.results["params"].update(test["params"])
+        if "version" in test.keys():
+            self.results["version"] = test["version"]
+        else:
+            # Unversioned tests are copies of REPO_PATH.
+            self.results["version"] = GitVersion.head(os.environ["REPO_PATH"])
+        self.lava_run = args.lava_run
+        if self.lava_run and not find_executable("lava-test-case"):
+            self.logger.info(
+                "lava-test-case not found, '-l' or '--lava_run' option ignored'"
+            )
+            self.lava_run = False
+
+    def run(self):
+        with Timings.phase("parse"):
+            if self.log_parser is None:
+                # Output was not parsed while the test was running.
+                self.log_parser = LogParser(self.pattern, self.fixup)
+                self.log_parser.parse_file("%s/stdout.log" % self.test["test_path"])
+            if self.repeats is not None:
+                self.metrics = self.repeats.metrics()
+                self.results["repeats"] = self.repeats.summary()
+            else:
+                self.metrics = self.log_parser.metrics()
+        if self.lava_run:
+            with Timings.phase("lava"):
+                self.send_to_lava()
+        # If 'metrics' is empty, add 'no-result-found fail'.
+        if not self.metrics:
+            self.metrics = [
                 {
                     "test_case_id": "no-result-found",
                     "result": "fail",
@@ -864,83 +2350,52 @@ class ResultParser(object):
                     "units": "",
                 }
             ]
+        self.metrics.extend(self.resource_metrics())
         self.results["metrics"] = self.metrics
-        self.dict_to_json()
-        self.dict_to_csv()
-        self.send_to_qa_reports()
-        self.send_to_fiotest()
+        if self.args.baseline_db:
+            with Timings.phase("baseline"):
+                baseline = BaselineStore(
+                    self.args.baseline_db,
+                    self.args.regression_threshold,
+                    self.args.baseline_window,
+                )
+                self.metrics.extend(baseline.check(self.results))
+                baseline.close()
+        with Timings.phase("json"):
+            self.dict_to_json()
+        with Timings.phase("csv"):
+            self.dict_to_csv()
+        with Timings.phase("qa_reports"):
+            self.send_to_qa_reports()
+        with Timings.phase("fiotest"):
+            self.send_to_fiotest()
         self.logger.info("Result files saved to: %s" % self.test["test_path"])
         print("--- Printing result.csv ---")
         with open("%s/result.csv" % self.test["test_path"]) as f:
             print(f.read())
 
-    def parse_stdout(self):
-        with open("%s/stdout.log" % self.test["test_path"], "r") as f:
-            test_case_re = re.compile("TEST_CASE_ID=(.*)")
-            result_re = re.compile("RESULT=(.*)")
-            measurement_re = re.compile("MEASUREMENT=(.*)")
-            units_re = re.compile("UNITS=(.*)")
-            for line in f:
-                if re.match(r"\<(|LAVA_SIGNAL_TESTCASE )TEST_CASE_ID=.*", line):
-                    line = line.strip("\n").strip("\r").strip("<>").split(" ")
-                    data = {
-                        "test_case_id": "",
-                        "result": "",
-                        "measurement": "",
-                        "units": "",
-                    }
+    def resource_metrics(self):
+        """Return the ResourceSampler summary as 'resource-*' metrics."""
+        path = "%s/resources.json" % self.test["test_path"]
+        if not os.path.isfile(path):
+            return []
+        with open(path, "r") as f:
+            summary = json.load(f)["summary"]
+        return [
+            {
+                "test_case_id": "resource-%s" % name,
+                "result": "pass",
+                "measurement": value,
+                "units": units,
+            }
+            for name, value, units in summary
+        ]
 
-                    for string in line:
-                        test_case_match = test_case_re.match(string)
-                        result_match = result_re.match(string)
-                        measurement_match = measurement_re.match(string)
-                        units_match = units_re.match(string)
-                        if test_case_match:
-                            data["test_case_id"] = test_case_match.group(1)
-                        if result_match:
-                            data["result"] = result_match.group(1)
-                        if measurement_match:
-                            try:
-                                data["measurement"] = float(measurement_match.group(1))
-                            except ValueError as e:
-                                pass
-                        if units_match:
-                            data["units"] = units_match.group(1)
-
-                    self.metrics.append(data.copy())
-
-                    if self.lava_run:
-                        self.send_to_lava(data)
-
-    def parse_pattern(self):
-        with open("%s/stdout.log" % self.test["test_path"], "r") as f:
-            rex_pattern = re.compile(r"%s" % self.pattern)
-            for line in f:
-                data = {}
-                m = rex_pattern.search(line)
-                if m:
-                    data = m.groupdict()
-                    for x in ["measurement", "units"]:
-                        if x not in data:
-                            data[x] = ""
-                    if self.fixup and data["result"] in self.fixup:
-                        data["result"] = self.fixup[data["result"]]
-
-                    self.metrics.append(data.copy())
-
-                    if self.lava_run:
-                        self.send_to_lava(data)
-
-    def send_to_lava(self, data):
-        cmd = "lava-test-case {} --result {}".format(
-            data["test_case_id"], data["result"]
-        )
-        if data["measurement"]:
-            cmd = "{} --measurement {} --units {}".format(
-                cmd, data["measurement"], data["units"]
-            )
-        self.logger.debug("lava-run: cmd: {}".format(cmd))
-        subprocess.call(shlex.split(cmd))
+    def send_to_lava(self):
+        reporter = LavaReporter(self.args.lava_report)
+        for data in self.metrics:
+            reporter.add(data)
+        reporter.close()
 
     def send_to_fiotest(self):
         """
@@ -992,7 +2447,6 @@ class ResultParser(object):
             )
             return
 
-        SquadApi.configure(url=self.qa_reports_server, token=self.qa_reports_token)
         tests = {}
         metrics = {}
         for metric in self.metrics:
@@ -1005,9 +2459,6 @@ class ResultParser(object):
                     "{}/{}".format(self.test["test_name"], metric["test_case_id"])
                 ] = metric["result"]
 
-        with open("{}/stdout.log".format(self.test["test_path"]), "r") as logfile:
-            log = logfile.read()
-
         metadata = {}
         if not self.qa_reports_disable_metadata:
             if self.qa_reports_metadata:
@@ -1032,21 +2483,14 @@ class ResultParser(object):
                     self.logger.warning(
                         "Insufficient permissions to open metadata file"
                     )
-        if submit_results(
-            group_project_slug="{}/{}".format(
-                self.qa_reports_group, self.qa_reports_project
-            ),
-            build_version=self.qa_reports_build_version,
-            env_slug=self.qa_reports_env,
-            tests=tests,
-            metrics=metrics,
-            log=log,
-            metadata=metadata,
-            attachments=None,
-        ):
-            self.logger.info("Results pushed to QA Reports")
-        else:
-            self.logger.warning("Results upload to QA Reports failed!")
+        SquadUploader(self.args, self.test["output"]).spool(
+            self.test["test_uuid"],
+            tests,
+            metrics,
+            metadata,
+            "{}/stdout.log".format(self.test["test_path"]),
+        )
+        self.logger.info("Results queued for upload to QA Reports")
 
     def dict_to_json(self):
         # Save test results to output/test_id/result.json
@@ -1054,36 +2498,33 @@ class ResultParser(object):
             json.dump([self.results], f, indent=4)
 
         if not self.args.cleanup:
-            # Collect test results of all tests in output/result.json
-            feeds = []
-            if os.path.isfile("%s/result.json" % self.test["output"]):
-                with open("%s/result.json" % self.test["output"], "r") as f:
-                    feeds = json.load(f)
+            # Collect test results of all tests in output/result.jsonl
+            ResultStore(self.test["output"]).append(self.results)
 
-            feeds.append(self.results)
-            with open("%s/result.json" % self.test["output"], "w") as f:
-                json.dump(feeds, f, indent=4)
+    @staticmethod
+    def csv_params(params):
+        # Convert dict self.results['params'] to a string.
+        if not params:
+            return ""
+        return ";".join(["%s=%s" % (k, v) for k, v in params.items()])
+
+    def status(self):
+        """Return 'no-result-found', 'fail' or 'pass' for the run journal."""
+        if self.metrics[0]["test_case_id"] == "no-result-found":
+            return "no-result-found"
+        if any(metric["result"] == "fail" for metric in self.metrics):
+            return "fail"
+        return "pass"
 
     def dict_to_csv(self):
-        # Convert dict self.results['params'] to a string.
-        test_params = ""
-        if self.results["params"]:
-            params_dict = self.results["params"]
-            test_params = ";".join(["%s=%s" % (k, v) for k, v in params_dict.items()])
+        test_params = self.csv_params(self.results["params"])
 
         for metric in self.results["metrics"]:
             metric["name"] = self.results["name"]
             metric["test_params"] = test_params
 
         # Save test results to output/test_id/result.csv
-        fieldnames = [
-            "name",
-            "test_case_id",
-            "result",
-            "measurement",
-            "units",
-            "test_params",
-        ]
+        fieldnames = self.CSV_FIELDS
         with open("%s/result.csv" % self.test["test_path"], "w") as f:
             writer = csv.DictWriter(f, fieldnames=fieldnames)
             writer.writeheader()
@@ -1092,15 +2533,425 @@ class ResultParser(object):
 
         if not self.args.cleanup:
             # Collect test results of all tests in output/result.csv
-            if not os.path.isfile("%s/result.csv" % self.test["output"]):
-                with open("%s/result.csv" % self.test["output"], "w") as f:
+            with results_lock(self.test["output"]):
+                if not os.path.isfile("%s/result.csv" % self.test["output"]):
+                    with open("%s/result.csv" % self.test["output"], "w") as f:
+                        writer = csv.DictWriter(f, fieldnames=fieldnames)
+                        writer.writeheader()
+
+                with open("%s/result.csv" % self.test["output"], "a") as f:
                     writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
+                    for metric in self.results["metrics"]:
+                        writer.writerow(metric)
+
+
+class ResultStore(object):
+    """
+    Aggregated results of all tests in an output directory.
+
+    Each test appends one line to result.jsonl, so the cost of saving a
+    result does not grow with the number of tests already run. finalize()
+    converts the JSON Lines file into the legacy result.json list at the end
+    of the run. An existing result.json without result.jsonl, written by an
+    older test-runner, is imported on the first append.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.logger = logging.getLogger("RUNNER.ResultStore")
+        self.jsonl_path = os.path.join(output, "result.jsonl")
+        self.json_path = os.path.join(output, "result.json")
+
+    def append(self, result):
+        with results_lock(self.output):
+            if not os.path.isfile(self.jsonl_path) and os.path.isfile(self.json_path):
+                with open(self.json_path, "r") as f:
+                    legacy = json.load(f)
+                with open(self.jsonl_path, "w") as f:
+                    for record in legacy:
+                        f.write(json.dumps(record) + "\n")
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+    def records(self):
+        if not os.path.isfile(self.jsonl_path):
+            return
+        with open(self.jsonl_path, "r") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Partial line left by an interrupted run.
+                    self.logger.warning("Ignoring corrupted line in %s" % f.name)
+
+    def discard(self, uuids):
+        """Remove the results of the tests with the given uuids."""
+        if not uuids or not os.path.isfile(self.jsonl_path):
+            return
+        uuids = set(uuids)
+        with results_lock(self.output):
+            records = [
+                record
+                for record in self.records()
+                if record["id"].rsplit("_", 1)[-1] not in uuids
+            ]
+            with open(self.jsonl_path + ".tmp", "w") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+            os.rename(self.jsonl_path + ".tmp", self.jsonl_path)
+            with open(os.path.join(self.output, "result.csv"), "w") as f:
+                writer = csv.DictWriter(f, fieldnames=ResultParser.CSV_FIELDS)
+                writer.writeheader()
+                for record in records:
+                    test_params = ResultParser.csv_params(record["params"])
+                    for metric in record["metrics"]:
+                        metric["name"] = record["name"]
+                        metric["test_params"] = test_params
+                        writer.writerow(metric)
+
+    def finalize(self):
+        if not os.path.isfile(self.jsonl_path):
+            return
+        with results_lock(self.output):
+            # Same layout as json.dump(records, f, indent=4), one record at a
+            # time.
+            with open(self.json_path + ".tmp", "w") as f:
+                f.write("[")
+                separator = "\n"
+                for record in self.records():
+                    f.write(separator)
+                    f.write(textwrap.indent(json.dumps(record, indent=4), "    "))
+                    separator = ",\n"
+                f.write("\n]" if separator != "\n" else "]")
+            os.rename(self.json_path + ".tmp", self.json_path)
+        self.logger.info("Results saved to: %s" % self.json_path)
+
+
+class RunJournal(object):
+    """
+    Progress of a test plan run, used by --resume.
+
+    <output>/journal.jsonl gets a 'plan' event with the command line and the
+    tests to run (with their ids) when the run starts, then a 'start' and a
+    'done' event for every test. An interrupted run can then be resumed: the
+    tests that are done, or whose results are already in result.jsonl, are
+    skipped and the tests that were running are started again from scratch.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.path = os.path.join(output, "journal.jsonl")
+        self.logger = logging.getLogger("RUNNER.RunJournal")
+
+    def write(self, event, **fields):
+        os.makedirs(self.output, exist_ok=True)
+        fields["event"] = event
+        fields["time"] = time.time()
+        with file_lock(os.path.join(self.output, ".journal.lock")):
+            with open(self.path, "a") as f:
+                f.write(json.dumps(fields) + "\n")
+
+    def plan(self, test_list):
+        self.write("plan", argv=sys.argv[1:], cwd=os.getcwd(), tests=test_list)
+
+    def events(self):
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Partial line left by an interrupted run.
+                    continue
+
+    def last_plan(self):
+        plan = None
+        for event in self.events():
+            if event["event"] == "plan":
+                plan = event
+        if plan is None:
+            self.logger.error("No test plan recorded in %s" % self.path)
+            sys.exit(1)
+        return plan
+
+    def resume(self, rerun_failed=False):
+        """Return (tests to run, ids of tests to run again)."""
+        plan = self.last_plan()
+        status = {}
+        started = set()
+        for event in self.events():
+            if event["event"] == "start":
+                started.add(event["uuid"])
+            elif event["event"] == "done":
+                status[event["uuid"]] = event["status"]
+        # Results saved just before an interruption.
+        for record in ResultStore(self.output).records():
+            status.setdefault(record["id"].rsplit("_", 1)[-1], "recorded")
+
+        tests = []
+        rerun = []
+        for test in plan["tests"]:
+            uuid = test["uuid"]
+            if uuid not in status:
+                if uuid in started:
+                    self.logger.info("Restarting interrupted test %s" % test["path"])
+                tests.append(test)
+            elif rerun_failed and status[uuid] in ("fail", "no-result-found"):
+                self.logger.info(
+                    "Running %s test %s again" % (status[uuid], test["path"])
+                )
+                tests.append(test)
+                rerun.append(uuid)
+        self.logger.info(
+            "Resuming: %s of %s tests to run" % (len(tests), len(plan["tests"]))
+        )
+        return tests, rerun
+
+
+class SquadUploader(object):
+    """
+    Upload results to SQUAD (qa-reports) in the background.
+
+    ResultParser only writes a submission for each test into a spool
+    directory, <output>/.squad-spool, together with a copy of its log
+    (optionally gzipped). A separate uploader process, started by
+    run_plan(), sends up to --qa-reports-batch-size spooled tests in one
+    submission and removes them once SQUAD accepted them. Failed uploads are
+    retried with exponential backoff. Submissions still spooled when the
+    runner stops, or crashes, are sent by the next run using the same
+    output directory.
+    """
+
+    POLL_INTERVAL = 1
+    BACKOFF = 2
+    BACKOFF_MAX = 300
+    # Consecutive failures accepted while draining the spool at the end,
+    # and the longest wait between them.
+    FINAL_ATTEMPTS = 5
+    FINAL_BACKOFF_MAX = 10
+
+    def __init__(self, args, output):
+        self.args = args
+        self.logger = logging.getLogger("RUNNER.SquadUploader")
+        self.spool_dir = os.path.join(output, ".squad-spool")
+        self.batch_size = max(1, args.qa_reports_batch_size)
+        self.gzip_logs = args.qa_reports_gzip_logs
+        self.process = None
+        self.stopping = None
+
+    def enabled(self):
+        return None not in (
+            self.args.qa_reports_server,
+            get_qa_reports_token(self.args),
+            self.args.qa_reports_group,
+            self.args.qa_reports_project,
+            self.args.qa_reports_build_version,
+            self.args.qa_reports_env,
+        )
+
+    def spool(self, name, tests, metrics, metadata, log_path):
+        """Queue the results of one test for upload."""
+        submission = {
+            "name": name,
+            "group": self.args.qa_reports_group,
+            "project": self.args.qa_reports_project,
+            "build": self.args.qa_reports_build_version,
+            "environment": self.args.qa_reports_env,
+            "tests": tests,
+            "metrics": metrics,
+            "metadata": metadata,
+        }
+        entry = "%s-%s" % (time.time_ns(), name)
+        tmp_path = os.path.join(self.spool_dir, "tmp-%s" % entry)
+        os.makedirs(tmp_path)
+        with open(os.path.join(tmp_path, "submission.json"), "w") as f:
+            json.dump(submission, f)
+        if os.path.isfile(log_path):
+            if self.gzip_logs:
+                with open(log_path, "rb") as src, gzip.open(
+                    os.path.join(tmp_path, "stdout.log.gz"), "wb"
+                ) as dst:
+                    shutil.copyfileobj(src, dst)
+            else:
+                shutil.copy(log_path, os.path.join(tmp_path, "stdout.log"))
+        os.rename(tmp_path, os.path.join(self.spool_dir, entry))
+
+    def pending(self):
+        if not os.path.isdir(self.spool_dir):
+            return []
+        return sorted(
+            os.path.join(self.spool_dir, entry)
+            for entry in os.listdir(self.spool_dir)
+            if not entry.startswith("tmp-")
+        )
+
+    def next_batch(self):
+        """
+        Return up to batch_size spooled entries for the same SQUAD build.
+
+        The batch stops before an entry repeating a test or metric name, or
+        changing a metadata value, of the batch: merged into one submission
+        it would overwrite the earlier result.
+        """
+        batch = []
+        key = None
+        tests = set()
+        metrics = set()
+        metadata = {}
+        for path in self.pending():
+            with open(os.path.join(path, "submission.json"), "r") as f:
+                submission = json.load(f)
+            entry_key = [
+                submission[k] for k in ["group", "project", "build", "environment"]
+            ]
+            if key is None:
+                key = entry_key
+            if entry_key != key:
+                continue
+            if (
+                tests.intersection(submission["tests"])
+                or metrics.intersection(submission["metrics"])
+                or any(
+                    metadata.get(name, value) != value
+                    for name, value in submission["metadata"].items()
+                )
+            ):
+                break
+            tests.update(submission["tests"])
+            metrics.update(submission["metrics"])
+            metadata.update(submission["metadata"])
+            batch.append((path, submission))
+            if len(batch) == self.batch_size:
+                break
+        return batch
+
+    def submit(self, batch):
+        first = batch[0][1]
+        data = {}
+        tests = {}
+        metrics = {}
+        metadata = {}
+        logs = []
+        files = []
+        for path, submission in batch:
+            tests.update(submission["tests"])
+            metrics.update(submission["metrics"])
+            metadata.update(submission["metadata"])
+            log_path = os.path.join(path, "stdout.log")
+            gz_path = os.path.join(path, "stdout.log.gz")
+            if os.path.isfile(gz_path):
+                with open(gz_path, "rb") as f:
+                    files.append(
+                        ("attachment", ("%s.log.gz" % submission["name"], f.read()))
+                    )
+            elif os.path.isfile(log_path):
+                with open(log_path, "r", errors="replace") as f:
+                    if len(batch) > 1:
+                        logs.append("=== %s ===\n" % submission["name"])
+                    logs.append(f.read())
+        if tests:
+            data["tests"] = json.dumps(tests)
+        if metrics:
+            data["metrics"] = json.dumps(metrics)
+        if metadata:
+            data["metadata"] = json.dumps(metadata)
+        if logs:
+            data["log"] = "".join(logs)
+
+        endpoint = "/api/submit/%s/%s/%s/%s" % (
+            first["group"],
+            first["project"],
+            first["build"],
+            first["environment"],
+        )
+        try:
+            response = SquadApi.post(endpoint, data=data, files=files)
+        except Exception as e:
+            self.logger.warning("Results upload to QA Reports failed: %s" % e)
+            return False
+        if not response.ok:
+            self.logger.warning(
+                "Results upload to QA Reports failed: %s %s"
+                % (response.status_code, response.text)
+            )
+            return False
+        self.logger.info(
+            "Results of %s pushed to QA Reports"
+            % ", ".join(submission["name"] for path, submission in batch)
+        )
+        return True
+
+    def configure(self):
+        """Connect to SQUAD, which queries its version."""
+        try:
+            SquadApi.configure(
+                url=self.args.qa_reports_server, token=get_qa_reports_token(self.args)
+            )
+        except Exception as e:
+            self.logger.warning("Unable to configure QA Reports upload: %s" % e)
+            return False
+        return True
+
+    def run(self):
+        configured = False
+        failures = 0
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                if self.stopping.is_set():
+                    break
+                self.stopping.wait(self.POLL_INTERVAL)
+                continue
+            # Retried like submissions, e.g. after a DNS failure at startup.
+            if not configured:
+                configured = self.configure()
+            if configured and self.submit(batch):
+                for path, submission in batch:
+                    shutil.rmtree(path, ignore_errors=True)
+                failures = 0
+                continue
+            failures += 1
+            delay = min(self.BACKOFF_MAX, self.BACKOFF**failures)
+            if self.stopping.is_set():
+                if failures >= self.FINAL_ATTEMPTS:
+                    break
+                time.sleep(min(self.FINAL_BACKOFF_MAX, delay))
+            else:
+                # Cut short by close().
+                self.stopping.wait(delay)
+        left = len(self.pending())
+        if left:
+            self.logger.warning(
+                "%s submissions left in %s, they will be uploaded by the next run"
+                % (left, self.spool_dir)
+            )
+
+    def start(self):
+        if not self.enabled():
+            return
+        if "SquadApi" not in globals():
+            self.logger.error("squad_client is not installed, results not uploaded")
+            return
+        context = multiprocessing.get_context("fork")
+        self.stopping = context.Event()
+        self.process = context.Process(target=self.run)
+        self.process.start()
+
+    def close(self):
+        """Wait until the spool is drained or uploads keep failing."""
+        if self.process is None:
+            return
+        self.stopping.set()
+        self.process.join()
 
-            with open("%s/result.csv" % self.test["output"], "a") as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                for metric in self.results["metrics"]:
-                    writer.writerow(metric)
+
+def get_qa_reports_token(args):
+    if args.qa_reports_token is not None:
+        return args.qa_reports_token
+    return os.environ.get(
+        "QA_REPORTS_TOKEN", get_token_from_netrc(args.qa_reports_server)
+    )
 
 
 def get_token_from_netrc(qa_reports_server):
@@ -1116,7 +2967,7 @@ def get_token_from_netrc(qa_reports_server):
     return
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument(
         "-o",
@@ -1173,25 +3024,202 @@ def get_args():
         ),
     )
     parser.add_argument(
-        "-k",
-        "--kind",
-        default="automated",
-        dest="kind",
-        choices=["automated", "manual"],
+        "--shard",
+        default=None,
+        dest="shard",
+        metavar="INDEX/COUNT",
         help=textwrap.dedent(
             """\
-                        Selects type of tests to be executed from the test plan.
-                        Possible options: automated, manual
+                        Only run one shard of the test plan, e.g. 2/4 runs the
+                        second of four shards. Shards are balanced by the
+                        durations recorded in --runtime-history.
                         """
         ),
     )
     parser.add_argument(
-        "-t",
-        "--timeout",
-        type=int,
-        default=None,
-        dest="timeout",
-        help="Specify test timeout",
+        "--runtime-history",
+        default=os.getenv("HOME", "") + "/.cache/test-runner/runtimes.json",
+        dest="runtime_history",
+        help=textwrap.dedent(
+            """\
+                        File with the durations of previous test runs. It is
+                        updated after every test and used to balance shards.
+                        --shard runs record to <output>/runtimes.json instead,
+                        see --merge-runtimes.
+                        Default: $HOME/.cache/test-runner/runtimes.json
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--merge-runtimes",
+        nargs="+",
+        default=None,
+        dest="merge_runtimes",
+        metavar="OUTPUT",
+        help=textwrap.dedent(
+            """\
+                        Merge the test durations recorded by --shard runs in
+                        these output directories into --runtime-history, then
+                        exit. Run it once all the shards of a plan ran.
+                        """
+        ),
+    )
+    parser.add_argument(
+        "-k",
+        "--kind",
+        default="automated",
+        dest="kind",
+        choices=["automated", "manual"],
+        help=textwrap.dedent(
+            """\
+                        Selects type of tests to be executed from the test plan.
+                        Possible options: automated, manual
+                        """
+        ),
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=int,
+        default=None,
+        dest="timeout",
+        help="Specify test timeout",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=1,
+        dest="repeat",
+        help=textwrap.dedent(
+            """\
+                        Run every test REPEAT times and report the median of
+                        each measurement, with its confidence interval,
+                        coefficient of variation and outliers. Default: 1
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=0,
+        dest="warmup",
+        help=textwrap.dedent(
+            """\
+                        Number of runs of every test to discard before the
+                        --repeat runs. Default: 0
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--baseline-db",
+        default=None,
+        dest="baseline_db",
+        help=textwrap.dedent(
+            """\
+                        SQLite database of previous measurements. Every
+                        measurement is compared with its history for the
+                        same test, board and kernel, and recorded.
+                        Regressions are reported as '<test case>-regression'
+                        fail results. Default: disabled
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--regression-threshold",
+        type=float,
+        default=5.0,
+        dest="regression_threshold",
+        help=textwrap.dedent(
+            """\
+                        Minimum change from the baseline median, in percent,
+                        reported as a regression. Default: 5
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--baseline-window",
+        type=int,
+        default=BaselineStore.WINDOW,
+        dest="baseline_window",
+        help=textwrap.dedent(
+            """\
+                        Number of previous measurements the baseline is
+                        computed from. Default: %s
+                        """
+            % BaselineStore.WINDOW
+        ),
+    )
+    parser.add_argument(
+        "--sample-interval",
+        type=float,
+        default=None,
+        dest="sample_interval",
+        help=textwrap.dedent(
+            """\
+                        Sample CPU utilisation and frequency, memory,
+                        temperatures, thermal throttling and interrupts of
+                        the system under test every SAMPLE_INTERVAL seconds
+                        while tests run. Samples are saved to resources.json
+                        next to stdout.log and summarised as 'resource-*'
+                        metrics. Default: disabled
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        dest="profile",
+        help=textwrap.dedent(
+            """\
+                        Profile test-runner itself with cProfile. Stats of
+                        every test are saved to OUTPUT/profiles/TEST.prof,
+                        to be read with 'python3 -m pstats'.
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--output-capture",
+        default="pexpect",
+        choices=["pexpect", "stream"],
+        dest="output_capture",
+        help=textwrap.dedent(
+            """\
+                        How test output is captured. 'pexpect' reads it line
+                        by line, the test running in a pseudo terminal.
+                        'stream' reads the output in large chunks straight
+                        into stdout.log; the test's stdout and stderr are a
+                        pipe and its stdin /dev/null. Default: pexpect
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--echo-rate",
+        type=int,
+        default=None,
+        dest="echo_rate",
+        help=textwrap.dedent(
+            """\
+                        Limit the test output printed to the console to
+                        ECHO_RATE KiB per second, 0 disables it. The full
+                        output is always kept in stdout.log. Only used with
+                        --output-capture stream. Default: no limit
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--capture-cpu-limit",
+        type=float,
+        default=None,
+        dest="capture_cpu_limit",
+        help=textwrap.dedent(
+            """\
+                        Maximum share of wall time, in percent, spent
+                        capturing test output. Capture backs off and reads
+                        larger chunks when it uses more. Only used with
+                        --output-capture stream. Default: no limit
+                        """
+        ),
     )
     parser.add_argument(
         "-g",
@@ -1206,6 +3234,75 @@ def get_args():
                         """
         ),
     )
+    parser.add_argument(
+        "--targets",
+        default=[],
+        dest="targets",
+        nargs="+",
+        metavar="USER@HOST",
+        help=textwrap.dedent(
+            """\
+                        Run the test plan on several SSH targets at the same
+                        time. Can be combined with --target and
+                        --target-inventory.
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--target-inventory",
+        default=None,
+        dest="target_inventory",
+        help=textwrap.dedent(
+            """\
+                        File with one SSH target (user@host) per line.
+                        Empty lines and '#' comments are ignored.
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--target-mode",
+        default="shard",
+        dest="target_mode",
+        choices=["shard", "replicate"],
+        help=textwrap.dedent(
+            """\
+                        How tests are distributed when several targets are
+                        given.
+                        shard: split the tests between the targets.
+                        replicate: run all tests on every target.
+                        Default: shard
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--target-sync",
+        default="archive",
+        dest="target_sync",
+        choices=["archive", "incremental"],
+        help=textwrap.dedent(
+            """\
+                        How test files are copied to the SSH target.
+                        archive: send a tarball of all test files per test.
+                        incremental: only send files missing from a
+                        content-addressed cache kept in
+                        ~/.cache/test-runner on the target.
+                        Default: archive
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--disable-ssh-multiplexing",
+        dest="disable_ssh_multiplexing",
+        default=False,
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+                        Open a new ssh connection for every command run on the
+                        target instead of sharing one connection for the whole
+                        run.
+                        """
+        ),
+    )
     parser.add_argument(
         "-s",
         "--skip_install",
@@ -1222,6 +3319,22 @@ def get_args():
         action="store_true",
         help="skip environmental data collection (board name, distro, etc)",
     )
+    parser.add_argument(
+        "--environment-packages",
+        default="inline",
+        dest="environment_packages",
+        choices=["inline", "reference"],
+        help=textwrap.dedent(
+            """\
+                        How the installed package list is stored in results.
+                        inline: copy the list into every test result.
+                        reference: write the list once to
+                        ${OUTPUT}/packages-<hash>.json and reference it from
+                        each result with 'packages_file'.
+                        Default: inline
+                        """
+        ),
+    )
     parser.add_argument(
         "-l",
         "--lava_run",
@@ -1230,6 +3343,21 @@ def get_args():
         action="store_true",
         help="send test result to LAVA with lava-test-case.",
     )
+    parser.add_argument(
+        "--lava-report",
+        default="test-case",
+        dest="lava_report",
+        choices=["test-case", "signal"],
+        help=textwrap.dedent(
+            """\
+                        How results are sent to LAVA with --lava_run.
+                        test-case: call lava-test-case for every result.
+                        signal: print LAVA_SIGNAL_TESTCASE lines in batches
+                        without starting a process per result.
+                        Default: test-case
+                        """
+        ),
+    )
     parser.add_argument(
         "-O",
         "--overlay",
@@ -1244,6 +3372,38 @@ def get_args():
                         """
         ),
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        dest="jobs",
+        help=textwrap.dedent(
+            """\
+                        Number of tests to run in parallel. Tests marked with
+                        'exclusive: true' in the test plan always run alone.
+                        Test output is only written to each test's stdout.log
+                        when more than one job is used. Default: 1
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--repo-snapshot",
+        default="copy",
+        dest="repo_snapshot",
+        choices=["copy", "hardlink", "reflink"],
+        help=textwrap.dedent(
+            """\
+                        How the test repository is copied for each test.
+                        copy: full copy of the repository for every test.
+                        hardlink: hard link files from one snapshot per
+                        repository version.
+                        reflink: copy-on-write clone of the snapshot where
+                        the filesystem supports it, plain copy otherwise.
+                        Default: copy
+                        """
+        ),
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -1310,6 +3470,67 @@ def get_args():
         default=None,
         help="YAML file that defines metadata to be reported to SQUAD",
     )
+    parser.add_argument(
+        "--resume",
+        default=None,
+        dest="resume",
+        help=textwrap.dedent(
+            """\
+                        Resume the interrupted run whose results are in the
+                        RESUME directory, with the same options and tests.
+                        Tests already done are skipped.
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--rerun-failed",
+        default=False,
+        action="store_true",
+        dest="rerun_failed",
+        help=textwrap.dedent(
+            """\
+                        With --resume, also run again the tests that failed
+                        or reported no-result-found.
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--results-jsonl-only",
+        dest="results_jsonl_only",
+        default=False,
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+                        Only save aggregated results in ${OUTPUT}/result.jsonl,
+                        one JSON object per test, and do not convert them to
+                        ${OUTPUT}/result.json at the end of the run.
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--qa-reports-batch-size",
+        dest="qa_reports_batch_size",
+        type=int,
+        default=1,
+        help=textwrap.dedent(
+            """\
+                        Number of tests sent to SQUAD in one submission.
+                        Default: 1
+                        """
+        ),
+    )
+    parser.add_argument(
+        "--qa-reports-gzip-logs",
+        dest="qa_reports_gzip_logs",
+        default=False,
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+                        Send test logs to SQUAD as gzipped attachments instead
+                        of the plain text test run log.
+                        """
+        ),
+    )
     parser.add_argument(
         "--cleanup",
         dest="cleanup",
@@ -1325,10 +3546,406 @@ def get_args():
         ),
     )
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
+def output_dir(args):
+    """Return the absolute directory where test results are stored."""
+    if args.resume:
+        return os.path.realpath(args.resume)
+    output = os.path.realpath(args.output)
+    # Multi-target runs always keep each target's results apart.
+    if args.target is not None and ("-o" not in sys.argv or len(args.targets) > 1):
+        output = os.path.join(output, args.target)
+    return output
+
+
+def run_test(test, args):
+    """Set up, run and parse a single test from the test plan.
+
+    This is the unit of work handed to TestScheduler. It only touches the
+    test's own directory, apart from the aggregated result files which are
+    updated under results_lock().
+    """
+    logger = logging.getLogger("RUNNER")
+    SSHMultiplexer.round_trips = 0
+    Timings.reset()
+    start = time.monotonic()
+    # Set and save test params to test dictionary.
+    test["test_name"] = os.path.splitext(test["path"].split("/")[-1])[0]
+    test["test_uuid"] = "%s_%s" % (test["test_name"], test["uuid"])
+    test["output"] = output_dir(args)
+    test["test_path"] = os.path.join(test["output"], test["test_uuid"])
+    journal = RunJournal(test["output"])
+    journal.write("start", uuid=test["uuid"], path=test["path"])
+    status = "missing"
+    if args.target is not None:
+        # Get relative directory path of yaml file for partial file copy.
+        # '-d' takes any relative paths to the yaml file, so get the realpath first.
+        tc_realpath = os.path.realpath(test["path"])
+        tc_dirname = os.path.dirname(tc_realpath)
+        test["tc_relative_dir"] = "%s%s" % (
+            args.kind,
+            tc_dirname.split(args.kind)[1],
+        )
+        target_user_home = target_home(args.target)
+        test["target_test_path"] = "%s/output/%s" % (
+            target_user_home,
+            test["test_uuid"],
+        )
+        test["target_cache_path"] = "%s/.cache/test-runner" % target_user_home
+    logger.debug("Test parameters: %s" % test)
+
+    # Create directories and copy files needed.
+    setup = TestSetup(test, args)
+    with Timings.phase("copy_test_repo"):
+        setup.create_dir()
+        setup.copy_test_repo()
+    setup.create_uuid_file()
+
+    # Convert test definition.
+    test_def = TestDefinition(test, args)
+    if test_def.exists:
+        with Timings.phase("definition"):
+            test_def.definition()
+            test_def.metadata()
+        with Timings.phase("mkrun"):
+            test_def.mkrun()
+
+        # Run test.
+        sampler = None
+        if args.sample_interval and args.kind != "manual":
+            sampler = ResourceSampler(test, args)
+            sampler.start()
+        repeats = None
+        runs = 1
+        if args.repeat > 1 or args.warmup:
+            if args.kind == "manual":
+                logger.warning("Manual tests are not repeated")
+            else:
+                repeats = RepeatStatistics(args.warmup)
+                runs = args.warmup + args.repeat
+        try:
+            for index in range(runs):
+                if repeats is not None:
+                    warmup = index < args.warmup
+                    label = (
+                        "warmup-%s" % (index + 1)
+                        if warmup
+                        else "run-%s" % (index - args.warmup + 1)
+                    )
+                    logger.info("%s: %s of %s" % (test["test_uuid"], label, runs))
+                with Timings.phase("run"):
+                    test_def.run()
+                if repeats is None:
+                    continue
+                if not warmup:
+                    repeats.add(test_def.runner.log_parser.metrics())
+                if index < runs - 1:
+                    # The last run keeps stdout.log.
+                    os.rename(
+                        "%s/stdout.log" % test["test_path"],
+                        "%s/stdout-%s.log" % (test["test_path"], label),
+                    )
+        finally:
+            if sampler is not None:
+                sampler.stop()
+
+        # Parse test output, save results in json and csv format.
+        with Timings.phase("results"):
+            result_parser = ResultParser(
+                test, args, test_def.runner.log_parser, repeats
+            )
+            result_parser.run()
+        status = result_parser.status()
+        history_path = args.runtime_history
+        if args.shard is not None:
+            # Shard runs leave the history alone, so that every shard of a
+            # plan is computed from the same durations.
+            history_path = os.path.join(output_dir(args), "runtimes.json")
+        RuntimeHistory(history_path).record(test, time.monotonic() - start)
+        if args.cleanup:
+            # remove a copy of test-definitions
+            logger.warning("Removing a copy of test-definitions")
+            logger.warning("Removing all collected logs")
+            with Timings.phase("cleanup"):
+                shutil.rmtree(test["test_path"])
+    else:
+        logger.warning("Requested test definition %s doesn't exist" % test["path"])
+    Timings.save(test["output"], test["test_uuid"])
+    journal.write("done", uuid=test["uuid"], status=status)
+    if args.target is not None:
+        logger.info(
+            "%s used %s ssh round trips"
+            % (test["test_uuid"], SSHMultiplexer.round_trips)
+        )
+    return test["test_uuid"]
+
+
+def profile_test(test, args):
+    """Run run_test() under cProfile, saving stats in <output>/profiles."""
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(run_test, test, args)
+    finally:
+        path = os.path.join(output_dir(args), "profiles")
+        os.makedirs(path, exist_ok=True)
+        stats_file = os.path.join(path, "%s.prof" % test["test_uuid"])
+        profiler.dump_stats(stats_file)
+        logging.getLogger("RUNNER").info("Profile saved to: %s" % stats_file)
+
+
+def check_target(args):
+    """Validate args.target format and connectivity, exit on failure."""
+    logger = logging.getLogger("RUNNER")
+    rex = re.compile(".+@.+")
+    if not rex.match(args.target):
+        logger.error("Usage: -g username@host")
+        sys.exit(1)
+    if pexpect.which("ssh") is None:
+        logger.error("openssh client must be installed on the host.")
+        sys.exit(1)
+    if not args.disable_ssh_multiplexing:
+        SSHMultiplexer.start()
+    try:
+        # Checks the login, and resolves the home directory used by tests.
+        target_home(args.target)
+    except subprocess.CalledProcessError as e:
+        logger.error("ssh login failed.")
+        print(e)
+        SSHMultiplexer.stop(args.target)
+        sys.exit(1)
+
+
+def get_targets(args):
+    """Return all SSH targets from --target, --targets and --target-inventory."""
+    targets = []
+    if args.target:
+        targets.append(args.target)
+    targets.extend(args.targets)
+    if args.target_inventory:
+        with open(args.target_inventory, "r") as f:
+            for line in f:
+                line = line.split("#", 1)[0].strip()
+                if line:
+                    targets.append(line)
+    unique_targets = []
+    for target in targets:
+        if target not in unique_targets:
+            unique_targets.append(target)
+    return unique_targets
+
+
+def run_plan(args, test_list):
+    """Run test_list on the local host or on args.target."""
+    output = output_dir(args)
+    Timings.reset()
+    with Timings.phase("repo_snapshot"):
+        RepoSnapshot(args).prepare(test_list)
+    if any("version" not in test for test in test_list):
+        # Resolved once here, inherited by parallel test processes.
+        GitVersion.head(os.environ["REPO_PATH"])
+
+    if not args.skip_environment:
+        with Timings.phase("environment"):
+            EnvironmentCache(args).collect()
+
+    uploader = SquadUploader(args, output)
+    uploader.start()
+    if os.path.isdir(output):
+        Timings.save(output, "plan-setup")
+
+    # Run tests.
+    scheduler = TestScheduler(args)
+    try:
+        scheduler.run(test_list)
+    finally:
+        Timings.reset()
+        with Timings.phase("qa_reports_upload"):
+            uploader.close()
+        if args.target:
+            SSHMultiplexer.stop(args.target)
+        if not args.results_jsonl_only:
+            with Timings.phase("result_json"):
+                ResultStore(output).finalize()
+        if os.path.isdir(output):
+            Timings.save(output, "plan-teardown")
+            Timings.finalize(output)
+
+
+def run_target(target, args, test_list):
+    """Run test_list on one target of a multi-target run."""
+    args = copy.copy(args)
+    args.target = target
+    check_target(args)
+    run_plan(args, test_list)
+    return target
+
+
+class TargetDispatcher(object):
+    """
+    Run one test plan on several SSH targets at the same time.
+
+    Every target is driven by its own worker process running the usual
+    single target pipeline, with results in <output>/<target>. In 'shard'
+    mode the tests are split between the targets, in 'replicate' mode every
+    target runs the whole plan. When all targets are done their results are
+    merged into <output>/result.json, keyed by target, and
+    <output>/result.csv with an extra 'target' column.
+    """
+
+    def __init__(self, args, targets):
+        self.args = args
+        self.targets = targets
+        self.mode = args.target_mode
+        self.output = os.path.realpath(args.output)
+        self.logger = logging.getLogger("RUNNER.TargetDispatcher")
+
+    def assign(self, test_list):
+        """Return {target: tests} for the dispatch mode."""
+        if self.mode == "replicate":
+            assignment = {}
+            for target in self.targets:
+                tests = copy.deepcopy(test_list)
+                # Keep test ids unique across targets.
+                for test in tests:
+                    test["uuid"] = str(uuid4())
+                assignment[target] = tests
+            return assignment
+        shards = RuntimeHistory(self.args.runtime_history).shards(
+            test_list, len(self.targets)
+        )
+        return dict(zip(self.targets, shards))
+
+    def run(self, test_list):
+        self.logger.info(
+            "Running tests on %s targets (%s)" % (len(self.targets), self.mode)
+        )
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=len(self.targets),
+            mp_context=multiprocessing.get_context("fork"),
+        ) as executor:
+            futures = {
+                executor.submit(run_target, target, self.args, tests): target
+                for target, tests in self.assign(test_list).items()
+                if tests
+            }
+            for future in concurrent.futures.as_completed(futures):
+                target = futures[future]
+                try:
+                    future.result()
+                    self.logger.info("%s finished" % target)
+                except (Exception, SystemExit) as e:
+                    self.logger.error("%s failed: %s" % (target, e))
+        if not self.args.cleanup:
+            self.merge()
+
+    def merge(self):
+        results = {}
+        rows = []
+        for target in self.targets:
+            target_output = os.path.join(self.output, target)
+            records = list(ResultStore(target_output).records())
+            if records:
+                results[target] = records
+            csv_path = os.path.join(target_output, "result.csv")
+            if os.path.isfile(csv_path):
+                with open(csv_path, "r") as f:
+                    for row in csv.DictReader(f):
+                        row["target"] = target
+                        rows.append(row)
+
+        if self.args.results_jsonl_only:
+            with open(os.path.join(self.output, "result.jsonl"), "w") as f:
+                for target, records in results.items():
+                    for record in records:
+                        record["target"] = target
+                        f.write(json.dumps(record) + "\n")
+        else:
+            with open(os.path.join(self.output, "result.json"), "w") as f:
+                json.dump(results, f, indent=4)
+        fieldnames = [
+            "target",
+            "name",
+            "test_case_id",
+            "result",
+            "measurement",
+            "units",
+            "test_params",
+        ]
+        with open(os.path.join(self.output, "result.csv"), "w") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+        self.logger.info("Merged results saved to: %s" % self.output)
+
+
+class TestScheduler(object):
+    """
+    Run tests from the test plan, optionally several at a time.
+
+    With --jobs 1 (the default) tests run one after another in the runner
+    process, exactly in plan order. With --jobs N the plan is cut into
+    segments at every test marked 'exclusive: true'; the tests inside a
+    segment run in a pool of N worker processes and every exclusive test
+    runs alone once all tests before it have finished. Worker processes are
+    used rather than threads because test setup changes the working
+    directory.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.jobs = args.jobs
+        self.run_test = profile_test if args.profile else run_test
+        self.logger = logging.getLogger("RUNNER.TestScheduler")
+        if self.jobs > 1 and args.kind == "manual":
+            self.logger.warning("Manual tests are interactive, ignoring --jobs")
+            self.jobs = 1
+
+    def segments(self, test_list):
+        """Split test_list into (exclusive, tests) groups, keeping plan order."""
+        segments = []
+        for test in test_list:
+            if test.get("exclusive", False):
+                segments.append((True, [test]))
+            elif segments and not segments[-1][0]:
+                segments[-1][1].append(test)
+            else:
+                segments.append((False, [test]))
+        return segments
+
+    def run(self, test_list):
+        if self.jobs <= 1:
+            for test in test_list:
+                self.run_test(test, self.args)
+            return
+
+        self.logger.info("Running tests with %s parallel jobs" % self.jobs)
+        for exclusive, tests in self.segments(test_list):
+            if exclusive:
+                self.logger.info("Running exclusive test: %s" % tests[0]["path"])
+                self.run_test(tests[0], self.args)
+                continue
+            self.run_parallel(tests)
+
+    def run_parallel(self, tests):
+        workers = min(self.jobs, len(tests))
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            futures = {
+                executor.submit(self.run_test, test, self.args): test for test in tests
+            }
+            for future in concurrent.futures.as_completed(futures):
+                test = futures[future]
+                try:
+                    self.logger.info("%s finished" % future.result())
+                except Exception as e:
+                    self.logger.error("%s failed: %s" % (test["path"], e))
+
+
 def main():
     args = get_args()
 
@@ -1343,87 +3960,66 @@ def main():
     ch.setFormatter(formatter)
     logger.addHandler(ch)
 
+    journal = None
+    if args.resume:
+        # Resume with the original options, the new ones take precedence.
+        journal = RunJournal(os.path.realpath(args.resume))
+        plan = journal.last_plan()
+        args = get_args(plan["argv"] + sys.argv[1:])
+        # Test and plan paths are relative to the original directory.
+        os.chdir(plan["cwd"])
+
     logger.debug("Test job arguments: %s" % args)
-    if args.kind != "manual" and args.target is None:
+    if args.merge_runtimes:
+        history = RuntimeHistory(args.runtime_history)
+        for output in args.merge_runtimes:
+            history.merge(output)
+        return
+
+    targets = get_targets(args)
+    args.targets = targets
+    if len(targets) == 1:
+        args.target = targets[0]
+    if args.kind != "manual" and not targets:
         if os.geteuid() != 0:
             logger.error("Sorry, you need to run this as root")
             sys.exit(1)
 
-    # Validate target argument format and connectivity.
-    if args.target:
-        rex = re.compile(".+@.+")
-        if not rex.match(args.target):
-            logger.error("Usage: -g username@host")
-            sys.exit(1)
-        if pexpect.which("ssh") is None:
-            logger.error("openssh client must be installed on the host.")
-            sys.exit(1)
-        try:
-            run_command("exit", args.target)
-        except subprocess.CalledProcessError as e:
-            logger.error("ssh login failed.")
-            print(e)
-            sys.exit(1)
+    # Validate target argument format and connectivity. With several
+    # targets, each one is checked by its own worker in run_target().
+    if len(targets) == 1:
+        check_target(args)
+    try:
+        run_tests(args, targets, journal)
+    finally:
+        if len(targets) == 1:
+            # Already stopped by run_plan() unless it failed early.
+            SSHMultiplexer.stop(args.target)
 
-    # Generate test plan.
-    test_plan = TestPlan(args)
-    test_list = test_plan.test_list(args.kind)
+
+def run_tests(args, targets, journal):
+    """Generate or resume the test plan, then run it on targets."""
+    logger = logging.getLogger("RUNNER")
+    if journal is not None:
+        if len(targets) > 1:
+            logger.error("--resume is not supported with several targets")
+            sys.exit(1)
+        test_list, rerun = journal.resume(args.rerun_failed)
+        ResultStore(output_dir(args)).discard(rerun)
+    else:
+        # Generate test plan.
+        test_plan = TestPlan(args)
+        test_list = test_plan.test_list(args.kind)
+        if len(targets) <= 1:
+            RunJournal(output_dir(args)).plan(test_list)
     logger.info("Tests to run:")
     for test in test_list:
         print(test)
 
-    # Run tests.
-    for test in test_list:
-        # Set and save test params to test dictionary.
-        test["test_name"] = os.path.splitext(test["path"].split("/")[-1])[0]
-        test["test_uuid"] = "%s_%s" % (test["test_name"], test["uuid"])
-        test["output"] = os.path.realpath(args.output)
-        if args.target is not None and "-o" not in sys.argv:
-            test["output"] = os.path.join(test["output"], args.target)
-        test["test_path"] = os.path.join(test["output"], test["test_uuid"])
-        if args.target is not None:
-            # Get relative directory path of yaml file for partial file copy.
-            # '-d' takes any relative paths to the yaml file, so get the realpath first.
-            tc_realpath = os.path.realpath(test["path"])
-            tc_dirname = os.path.dirname(tc_realpath)
-            test["tc_relative_dir"] = "%s%s" % (
-                args.kind,
-                tc_dirname.split(args.kind)[1],
-            )
-            target_user_home = run_command("echo $HOME", args.target)
-            test["target_test_path"] = "%s/output/%s" % (
-                target_user_home,
-                test["test_uuid"],
-            )
-        logger.debug("Test parameters: %s" % test)
-
-        # Create directories and copy files needed.
-        setup = TestSetup(test, args)
-        setup.create_dir()
-        setup.copy_test_repo()
-        setup.checkout_version()
-        setup.create_uuid_file()
-
-        # Convert test definition.
-        test_def = TestDefinition(test, args)
-        if test_def.exists:
-            test_def.definition()
-            test_def.metadata()
-            test_def.mkrun()
-
-            # Run test.
-            test_def.run()
-
-            # Parse test output, save results in json and csv format.
-            result_parser = ResultParser(test, args)
-            result_parser.run()
-            if args.cleanup:
-                # remove a copy of test-definitions
-                logger.warning("Removing a copy of test-definitions")
-                logger.warning("Removing all collected logs")
-                shutil.rmtree(test["test_path"])
-        else:
-            logger.warning("Requested test definition %s doesn't exist" % test["path"])
+    if len(targets) > 1:
+        TargetDispatcher(args, targets).run(test_list)
+    else:
+        run_plan(args, test_list)
 
 
 if __name__ == "__main__":
@@ -11,7 +11,7 @@ setup(
     author="Milosz Wasilewski",
     author_email="milosz.wasilewski@linaro.org",
     license="GPL",
-    python_requires=">=3.5",
+    python_requires=">=3.7",
     install_requires=["mkdocs>=1.1", "tags-macros-plugin"],
     classifiers=[
         "Development Status :: 5 - Production/Stable",
@@ -20,8 +20,6 @@ setup(
         "License :: OSI Approved :: GNU General Public License v2 or later (GPLv2+)",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3 :: Only",
-        "Programming Language :: Python :: 3.5",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
     ],
     packages=find_packages(),
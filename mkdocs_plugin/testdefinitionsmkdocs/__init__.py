@@ -1,6 +1,7 @@
 import errno
 import mdutils
 import os
+import sys
 import yaml
 
 from mkdocs.plugins import BasePlugin
@@ -8,6 +9,16 @@ from mkdocs.structure.files import File
 from mkdocs.config.config_options import Type
 from mdutils.fileutils.fileutils import MarkDownFile
 
+# automated/lib of the test-definitions repository the plugin is in. An
+# installed plugin uses the repository mkdocs runs from.
+lib_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "automated", "lib"
+)
+if not os.path.exists(os.path.join(lib_path, "py_testdef_lib.py")):
+    lib_path = os.path.join(os.getcwd(), "automated", "lib")
+sys.path.insert(0, os.path.normpath(lib_path))
+import py_testdef_lib  # nopep8
+
 
 class LinaroTestDefinitionsMkDocsPlugin(BasePlugin):
     config_scheme = (
@@ -38,14 +49,13 @@ class LinaroTestDefinitionsMkDocsPlugin(BasePlugin):
         # remove .yaml
         new_filename = new_filename.rsplit(".", 1)[0]
         tmp_filename = os.path.join(config["docs_dir"], new_filename)
-        filecontent = None
         try:
-            with open(filename, "r") as f:
-                filecontent = f.read()
+            content = py_testdef_lib.load(filename).data
         except FileNotFoundError:
             return None
+        except yaml.YAMLError:
+            return None
         try:
-            content = yaml.load(filecontent, Loader=yaml.Loader)
             if "metadata" in content.keys():
                 metadata = content["metadata"]
                 mdFile = mdutils.MdUtils(file_name=tmp_filename)
@@ -109,8 +119,6 @@ class LinaroTestDefinitionsMkDocsPlugin(BasePlugin):
                         }
                     )
                 return new_filename + ".md"
-        except yaml.YAMLError:
-            return None
         except KeyError:
             return None
 
@@ -6,11 +6,17 @@ import logging
 import os
 import pdfkit
 import subprocess
+import sys
 import yaml
 from argparse import ArgumentParser
 from csv import DictWriter
 from jinja2 import Environment, FileSystemLoader
 
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "../automated/lib")
+)
+import py_testdef_lib  # nopep8
+
 
 logger = logging.getLogger()
 
@@ -125,8 +131,7 @@ def test_exists(test, repositories, args):
     logger.debug("Current dir: {}".format(current_dir))
     os.chdir(current_dir)
     logger.debug("CWD: {}".format(os.getcwd()))
-    test_file = open(test_file_path, "r")
-    test_yaml = yaml.load(test_file.read(), Loader=yaml.FullLoader)
+    test_yaml = py_testdef_lib.load(test_file_path).data
     params_string = ""
     if "parameters" in test.keys():
         params_string = "_".join(
@@ -0,0 +1,69 @@
+"""Tests of automated/lib/py_testdef_lib.py, run with: python3 -m pytest test"""
+
+import datetime
+import os
+import sys
+
+import pytest
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_PATH, "automated", "lib"))
+import py_testdef_lib  # nopep8
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("TESTDEF_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(py_testdef_lib, "_memory_cache", {})
+    monkeypatch.setattr(py_testdef_lib, "_pruned", False)
+    return tmp_path
+
+
+def test_cached_load(cache):
+    content = b"metadata:\n  name: smoke\nrun:\n  steps:\n    - ./smoke.sh\n"
+    testdef = py_testdef_lib.load_content(content)
+    assert testdef.name == "smoke"
+    assert testdef.steps == ["./smoke.sh"]
+    entries = os.listdir(cache)
+    assert entries == ["%s-%s.json" % (testdef.sha1, py_testdef_lib.CACHE_VERSION)]
+
+    # Loaded from the disk cache, as a copy the caller may modify.
+    py_testdef_lib._memory_cache.clear()
+    testdef.data["run"]["steps"].append("modified")
+    assert py_testdef_lib.load_content(content).data == {
+        "metadata": {"name": "smoke"},
+        "run": {"steps": ["./smoke.sh"]},
+    }
+
+
+def test_data_json_does_not_represent_is_not_cached(cache):
+    data = py_testdef_lib.load_content(b"date: 2024-01-02\n1: one\n").data
+    assert data == {"date": datetime.date(2024, 1, 2), 1: "one"}
+    assert os.listdir(cache) == []
+    assert py_testdef_lib.load_content(b"date: 2024-01-02\n1: one\n").data == data
+
+
+def test_cache_is_pruned(cache, monkeypatch):
+    monkeypatch.setattr(py_testdef_lib, "MAX_CACHE_ENTRIES", 8)
+    for i in range(12):
+        entry = cache / ("%040d-%s.json" % (i, py_testdef_lib.CACHE_VERSION))
+        entry.write_text("{}")
+        os.utime(entry, (i, i))
+    (cache / ("%040d-1.pickle" % 0)).write_bytes(b"old version")
+    stale = cache / ".tmp-stale"
+    stale.write_text("{")
+    os.utime(stale, (0, 0))
+    # Being written by another process.
+    (cache / ".tmp-writing").write_text("{")
+    # Files the cache didn't create.
+    (cache / "notes.txt").write_text("notes")
+    (cache / "settings.json").write_text("{}")
+    (cache / ("%040d.json" % 0)).write_text("{}")
+
+    testdef = py_testdef_lib.load_content(b"name: new\n")
+    # The most recently used entries are kept, and the new one.
+    names = ["%040d" % i for i in range(6, 12)] + [testdef.sha1]
+    assert sorted(os.listdir(cache)) == sorted(
+        ["%s-%s.json" % (name, py_testdef_lib.CACHE_VERSION) for name in names]
+        + [".tmp-writing", "notes.txt", "settings.json", "%040d.json" % 0]
+    )
@@ -0,0 +1,781 @@
+"""Tests of automated/utils/test-runner.py, run with: python3 -m pytest test"""
+
+import argparse
+import copy
+import csv
+import http.server
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import pytest
+import yaml
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_RUNNER = os.path.join(REPO_PATH, "automated", "utils", "test-runner.py")
+
+
+def load_test_runner():
+    spec = importlib.util.spec_from_file_location("test_runner", TEST_RUNNER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def smoke_test(name):
+    return {
+        "path": "automated/linux/smoke/smoke.yaml",
+        "repository": "https://github.com/Linaro/test-definitions.git",
+        "parameters": {"SKIP_INSTALL": "true", "TESTS": name},
+    }
+
+
+def write_plan(path, tests):
+    plan = {
+        "metadata": {"name": "test", "format": "Linaro Test Plan v2"},
+        "tests": {"automated": tests},
+    }
+    with open(path, "w") as f:
+        yaml.safe_dump(plan, f)
+
+
+def write_testdef(path, name, steps):
+    with open(path, "w") as f:
+        yaml.safe_dump(
+            {
+                "metadata": {
+                    "name": name,
+                    "format": "Lava-Test Test Definition 1.0",
+                    "description": name,
+                },
+                "run": {"steps": steps},
+            },
+            f,
+        )
+
+
+def run_test_runner(*args):
+    subprocess.check_call(
+        [sys.executable, TEST_RUNNER, "--skip_environment"] + list(args),
+        cwd=REPO_PATH,
+        env=dict(os.environ, REPO_PATH=REPO_PATH),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def read_jsonl(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def write_jsonl(path, records):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="test-runner runs tests as root")
+def test_resume_interrupted_run(tmp_path):
+    names = ["pwd", "uname", "free", "lscpu"]
+    plan = tmp_path / "plan.yaml"
+    write_plan(plan, [smoke_test(name) for name in names])
+    output = tmp_path / "output"
+    run_test_runner("-p", str(plan), "-o", str(output))
+
+    # Interrupted while running 'free', after the result of 'uname' was
+    # saved but before it was marked done. 'lscpu' never started.
+    journal = read_jsonl(output / "journal.jsonl")
+    tests = {test["parameters"]["TESTS"]: test["uuid"] for test in journal[0]["tests"]}
+    interrupted = []
+    for event in journal:
+        uuid = event.get("uuid")
+        if uuid == tests["lscpu"] or uuid == tests["free"] and event["event"] == "done":
+            continue
+        if uuid == tests["uname"] and event["event"] == "done":
+            continue
+        interrupted.append(event)
+    write_jsonl(output / "journal.jsonl", interrupted)
+    results = read_jsonl(output / "result.jsonl")
+    kept = [
+        record for record in results if record["params"]["TESTS"] in ["pwd", "uname"]
+    ]
+    write_jsonl(output / "result.jsonl", kept)
+    os.remove(output / "result.json")
+
+    run_test_runner("--resume", str(output))
+    started = [
+        event["uuid"]
+        for event in read_jsonl(output / "journal.jsonl")[len(interrupted) :]
+        if event["event"] == "start"
+    ]
+    assert started == [tests["free"], tests["lscpu"]]
+    with open(output / "result.json") as f:
+        records = json.load(f)
+    # Every test once, the results saved before the interruption unchanged.
+    assert sorted(record["params"]["TESTS"] for record in records) == sorted(names)
+    assert records[:2] == kept
+    assert read_jsonl(output / "result.jsonl") == records
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="test-runner runs tests as root")
+def test_resume_rerun_failed(tmp_path):
+    flag = tmp_path / "flag"
+    write_testdef(
+        tmp_path / "passing.yaml",
+        "passing",
+        ['echo "<TEST_CASE_ID=always RESULT=pass>"'],
+    )
+    write_testdef(
+        tmp_path / "flaky.yaml",
+        "flaky",
+        [
+            "if [ -f %s ]; then result=pass; else result=fail; fi" % flag,
+            'echo "<TEST_CASE_ID=flag RESULT=$result>"',
+        ],
+    )
+    plan = tmp_path / "plan.yaml"
+    write_plan(
+        plan,
+        [{"path": str(tmp_path / name)} for name in ["passing.yaml", "flaky.yaml"]],
+    )
+    output = tmp_path / "output"
+    run_test_runner("-p", str(plan), "-o", str(output))
+    with open(output / "result.json") as f:
+        first = json.load(f)
+    assert [record["metrics"][0]["result"] for record in first] == ["pass", "fail"]
+
+    # Nothing left to run without --rerun-failed.
+    run_test_runner("--resume", str(output))
+    with open(output / "result.json") as f:
+        assert json.load(f) == first
+
+    flag.write_text("")
+    run_test_runner("--resume", str(output), "--rerun-failed")
+    with open(output / "result.json") as f:
+        records = json.load(f)
+    assert records[0] == first[0]
+    assert [record["name"] for record in records] == ["passing", "flaky"]
+    assert records[1]["id"] == first[1]["id"]
+    assert records[1]["metrics"][0]["result"] == "pass"
+    with open(output / "result.csv") as f:
+        rows = list(csv.DictReader(f))
+    assert [(row["name"], row["result"]) for row in rows] == [
+        ("passing", "pass"),
+        ("flaky", "pass"),
+    ]
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="test-runner runs tests as root")
+def test_shards_cover_the_plan_once(tmp_path):
+    names = ["pwd", "uname", "free", "lscpu", "lsblk", "lsb_release"]
+    plan = tmp_path / "plan.yaml"
+    write_plan(plan, [smoke_test(name) for name in names])
+
+    # Recorded durations far from the real ones: recording the new
+    # durations during the shard runs would change the partition.
+    test_runner = load_test_runner()
+    history = {
+        test_runner.RuntimeHistory.key(smoke_test(name)): [10.0 * (i + 1)]
+        for i, name in enumerate(names)
+    }
+    history_path = tmp_path / "runtimes.json"
+    history_path.write_text(json.dumps(history))
+
+    count = 3
+    shards = []
+    for index in range(1, count + 1):
+        output = tmp_path / ("shard-%d" % index)
+        subprocess.check_call(
+            [
+                sys.executable,
+                TEST_RUNNER,
+                "-p",
+                str(plan),
+                "-o",
+                str(output),
+                "--shard",
+                "%d/%d" % (index, count),
+                "--runtime-history",
+                str(history_path),
+                "--skip_environment",
+            ],
+            cwd=REPO_PATH,
+            env=dict(os.environ, REPO_PATH=REPO_PATH),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        with open(output / "result.json") as f:
+            shards.append([result["params"]["TESTS"] for result in json.load(f)])
+
+    ran = [name for shard in shards for name in shard]
+    assert sorted(ran) == sorted(names)
+    assert all(shards)
+    assert json.loads(history_path.read_text()) == history
+
+    # Merged once all the shards ran.
+    outputs = [str(tmp_path / ("shard-%d" % index)) for index in range(1, count + 1)]
+    subprocess.check_call(
+        [
+            sys.executable,
+            TEST_RUNNER,
+            "--runtime-history",
+            str(history_path),
+            "--merge-runtimes",
+        ]
+        + outputs,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    merged = json.loads(history_path.read_text())
+    assert merged.keys() == history.keys()
+    for key, durations in merged.items():
+        assert len(durations) == 2
+        assert durations[0] == history[key][0]
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="test-runner runs tests as root")
+def test_output_inside_the_repository(tmp_path):
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    plan = tmp_path / "plan.yaml"
+    write_plan(plan, [smoke_test("pwd")])
+    process = subprocess.run(
+        [
+            sys.executable,
+            TEST_RUNNER,
+            "-p",
+            str(plan),
+            "-o",
+            str(repo / "output"),
+            "--repo-snapshot",
+            "hardlink",
+            "--skip_environment",
+        ],
+        cwd=REPO_PATH,
+        env=dict(os.environ, REPO_PATH=str(repo)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        timeout=60,
+    )
+    assert process.returncode == 1
+    assert "Cannot copy repository into itself" in process.stderr
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="test-runner runs tests as root")
+@pytest.mark.parametrize("output_capture", ["pexpect", "stream"])
+def test_all_results_are_parsed(tmp_path, output_capture):
+    testdef = tmp_path / "many-results.yaml"
+    with open(testdef, "w") as f:
+        yaml.safe_dump(
+            {
+                "metadata": {
+                    "name": "many-results",
+                    "format": "Lava-Test Test Definition 1.0",
+                    "description": "Prints many results",
+                },
+                "run": {
+                    "steps": [
+                        "for i in $(seq 3000); do"
+                        ' echo "<TEST_CASE_ID=case-$i RESULT=pass>"; done'
+                    ]
+                },
+            },
+            f,
+        )
+    output = tmp_path / "output"
+    subprocess.check_call(
+        [
+            sys.executable,
+            TEST_RUNNER,
+            "-d",
+            str(testdef),
+            "-o",
+            str(output),
+            "--output-capture",
+            output_capture,
+            "--skip_environment",
+        ],
+        cwd=REPO_PATH,
+        env=dict(os.environ, REPO_PATH=REPO_PATH),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    with open(output / "result.json") as f:
+        results = json.load(f)[0]["metrics"]
+    assert len(results) == 3000
+
+
+def test_log_parser():
+    test_runner = load_test_runner()
+    parser = test_runner.LogParser(
+        pattern=r"^(?P<test_case_id>\w+): (?P<result>\w+)$", fixup={"ok": "pass"}
+    )
+    for line in [
+        "<TEST_CASE_ID=boot RESULT=pass>\n",
+        "<LAVA_SIGNAL_TESTCASE TEST_CASE_ID=speed RESULT=pass MEASUREMENT=1.5 UNITS=MB/s>\n",
+        "<TEST_CASE_ID=bad RESULT=fail MEASUREMENT=n/a>\r\n",
+        "  <TEST_CASE_ID=indented RESULT=pass>\n",
+        "login: ok\n",
+        "shutdown: fail\n",
+        "unrelated output\n",
+    ]:
+        parser.feed(line)
+    assert parser.metrics() == [
+        {"test_case_id": "boot", "result": "pass", "measurement": "", "units": ""},
+        {
+            "test_case_id": "speed",
+            "result": "pass",
+            "measurement": 1.5,
+            "units": "MB/s",
+        },
+        {"test_case_id": "bad", "result": "fail", "measurement": "", "units": ""},
+        {"test_case_id": "login", "result": "pass", "measurement": "", "units": ""},
+        {
+            "test_case_id": "shutdown",
+            "result": "fail",
+            "measurement": "",
+            "units": "",
+        },
+    ]
+
+
+def test_result_store_finalize(tmp_path):
+    test_runner = load_test_runner()
+    store = test_runner.ResultStore(str(tmp_path))
+    store.finalize()
+    assert not (tmp_path / "result.json").exists()
+
+    # result.json of an older test-runner, imported on the first append.
+    legacy = [{"id": "old_1", "metrics": [{"result": "pass"}], "params": {}}]
+    (tmp_path / "result.json").write_text(json.dumps(legacy, indent=4))
+    records = legacy + [
+        {
+            "id": "new_%d" % i,
+            "name": "new",
+            "metrics": [{"test_case_id": "case-%d" % i, "result": "pass"}],
+            "params": {"TESTS": "a b", "UNICODE": "\u00e9"},
+        }
+        for i in range(3)
+    ]
+    for record in records[1:]:
+        store.append(record)
+    # Partial line left by an interrupted run.
+    with open(tmp_path / "result.jsonl", "a") as f:
+        f.write('{"id": "partial')
+    store.finalize()
+    # The layout of the former json.dump(results, f, indent=4).
+    assert (tmp_path / "result.json").read_text() == json.dumps(records, indent=4)
+
+    (tmp_path / "result.jsonl").write_text("")
+    store.finalize()
+    assert (tmp_path / "result.json").read_text() == json.dumps([], indent=4)
+
+
+def test_repeat_statistics():
+    test_runner = load_test_runner()
+    repeats = test_runner.RepeatStatistics(warmup=1)
+    speeds = [10, 11, 12, 11, 10, 11, 50]
+    for index, speed in enumerate(speeds):
+        metrics = [
+            {
+                "test_case_id": "speed",
+                "result": "pass",
+                "measurement": str(speed),
+                "units": "MB/s",
+            },
+            {
+                "test_case_id": "boot",
+                "result": "fail" if index == 3 else "pass",
+                "measurement": "",
+                "units": "",
+            },
+        ]
+        if index == 0:
+            metrics.append(
+                {
+                    "test_case_id": "once",
+                    "result": "pass",
+                    "measurement": "",
+                    "units": "",
+                }
+            )
+        repeats.add(metrics)
+
+    def metric(test_case_id, result, measurement, units):
+        return {
+            "test_case_id": test_case_id,
+            "result": result,
+            "measurement": measurement,
+            "units": units,
+        }
+
+    assert repeats.metrics() == [
+        metric("speed", "pass", 11.0, "MB/s"),
+        metric("speed-ci-low", "pass", 10.0, "MB/s"),
+        metric("speed-ci-high", "pass", 50.0, "MB/s"),
+        metric("speed-cv", "pass", 90.206, "%"),
+        metric("speed-outliers", "pass", 1, "runs"),
+        # Failed in one run.
+        metric("boot", "fail", "", ""),
+        # Missing from the other runs.
+        metric("once", "fail", "", ""),
+    ]
+    summary = repeats.summary()
+    assert summary["runs"] == 7
+    assert summary["warmup"] == 1
+    assert summary["test_cases"]["speed"]["outliers"] == [False] * 6 + [True]
+
+
+def test_baseline_regressions(tmp_path):
+    test_runner = load_test_runner()
+    baseline = test_runner.BaselineStore(str(tmp_path / "baseline.db"), threshold=5.0)
+
+    def results(speed, latency, board="board-a"):
+        return {
+            "name": "bench",
+            "id": "bench_uuid",
+            "params": {"SIZE": "1M"},
+            "environment": {"board_name": board, "kernel": "6.1"},
+            "metrics": [
+                {
+                    "test_case_id": "speed",
+                    "result": "pass",
+                    "measurement": speed,
+                    "units": "MB/s",
+                },
+                {
+                    "test_case_id": "latency",
+                    "result": "pass",
+                    "measurement": latency,
+                    "units": "ms",
+                },
+                {
+                    "test_case_id": "speed-cv",
+                    "result": "pass",
+                    "measurement": 50.0,
+                    "units": "%",
+                },
+            ],
+        }
+
+    # Too little history to compare with.
+    for speed, latency in [(100, 10), (102, 10.2), (98, 9.8)]:
+        assert baseline.check(results(speed, latency)) == []
+    # Within the noise, and improvements.
+    assert baseline.check(results(97, 10.1)) == []
+    assert baseline.check(results(150, 5)) == []
+    # Higher is better for MB/s, lower for ms.
+    regressions = baseline.check(results(80, 13))
+    assert regressions == [
+        {
+            "test_case_id": "speed-regression",
+            "result": "fail",
+            "measurement": -20.0,
+            "units": "%",
+        },
+        {
+            "test_case_id": "latency-regression",
+            "result": "fail",
+            "measurement": 30.0,
+            "units": "%",
+        },
+    ]
+    # Other boards have their own baseline.
+    assert baseline.check(results(50, 20, board="board-b")) == []
+    # Past the threshold, but within the spread of a noisy history.
+    for speed in [100, 130, 70, 110, 90]:
+        baseline.check(results(speed, 10, board="board-c"))
+    assert baseline.check(results(80, 10, board="board-c")) == []
+    baseline.close()
+
+
+def linear_test_list(tests, overlay):
+    """
+    Reference for TestPlan.test_list() and apply_overlay(): the quadratic
+    implementation they replaced, without the uuids and the logging.
+    """
+    test_list = []
+    unique_tests = []
+    for test in tests:
+        test_hash = hash(json.dumps(test, sort_keys=True))
+        if test_hash not in unique_tests:
+            unique_tests.append(test_hash)
+            test_list.append(test)
+
+    fixed_test_list = copy.deepcopy(test_list)
+    if overlay.get("skip"):
+        for test in test_list:
+            for skip_test in overlay["skip"]:
+                if (
+                    test["path"] == skip_test["path"]
+                    and test["repository"] == skip_test["repository"]
+                ):
+                    fixed_test_list.remove(test)
+    if overlay.get("amend"):
+        for test in fixed_test_list:
+            for amend_test in overlay["amend"]:
+                if (
+                    test["path"] == amend_test["path"]
+                    and test["repository"] == amend_test["repository"]
+                    and amend_test.get("parameters")
+                ):
+                    if test.get("parameters"):
+                        test["parameters"].update(amend_test["parameters"])
+                    else:
+                        test["parameters"] = amend_test["parameters"]
+    if overlay.get("add"):
+        unique_add_tests = []
+        for test in overlay["add"]:
+            if test not in unique_add_tests:
+                unique_add_tests.append(test)
+        for add_test in unique_add_tests:
+            if add_test not in test_list:
+                fixed_test_list.append(add_test)
+    return fixed_test_list
+
+
+def generated_test(i):
+    test = {
+        "path": "automated/linux/test-%d/test-%d.yaml" % (i % 997, i % 997),
+        "repository": "https://example.com/repo-%d.git" % (i % 3),
+    }
+    if i % 5:
+        test["parameters"] = {"RUN": str(i % 7), "INDEX": str(i)}
+    return test
+
+
+def test_overlay_of_a_large_plan(tmp_path):
+    # TEST_RUNNER_PLAN_SIZE=50000 python3 -m pytest -s -k large_plan
+    # benchmarks both implementations on a plan of that size.
+    size = int(os.environ.get("TEST_RUNNER_PLAN_SIZE", "2000"))
+    tests = [generated_test(i) for i in range(size)]
+    # Duplicates, removed from the plan.
+    tests += [generated_test(i) for i in range(0, size, 25)]
+    overlay = {
+        "skip": [generated_test(i) for i in range(0, size, 31)],
+        "amend": [
+            dict(generated_test(i), parameters={"RUN": "amended", "EXTRA": str(i)})
+            for i in range(0, size, 13)
+        ]
+        + [generated_test(i) for i in range(0, size, 65)],
+        # New tests, tests already in the plan and duplicates.
+        "add": [generated_test(size + i) for i in range(size // 10)]
+        + [generated_test(i) for i in range(0, size, 17)]
+        + [generated_test(size + i) for i in range(0, size // 10, 7)],
+    }
+    plan = tmp_path / "plan.yaml"
+    write_plan(plan, tests)
+    overlay_path = tmp_path / "overlay.yaml"
+    with open(overlay_path, "w") as f:
+        yaml.safe_dump(overlay, f)
+
+    test_runner = load_test_runner()
+    args = argparse.Namespace(
+        test_def=None,
+        test_plan=str(plan),
+        timeout=None,
+        skip_install=False,
+        overlay=str(overlay_path),
+        shard=None,
+        runtime_history=None,
+    )
+    start = time.monotonic()
+    test_list = test_runner.TestPlan(args).test_list()
+    indexed = time.monotonic() - start
+    for test in test_list:
+        del test["uuid"]
+
+    start = time.monotonic()
+    expected = linear_test_list(copy.deepcopy(tests), copy.deepcopy(overlay))
+    linear = time.monotonic() - start
+    print(
+        "%d tests: indexed %.2fs (YAML included), linear %.2fs"
+        % (len(tests), indexed, linear)
+    )
+    assert test_list == expected
+
+
+class FakeSquad(http.server.BaseHTTPRequestHandler):
+    """SQUAD stand-in, failing the number of requests set in `failures`."""
+
+    failures = {"GET": 0, "POST": 0}
+    submissions = []
+
+    def reply(self, code, body):
+        self.send_response(code)
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def do_GET(self):
+        if self.failures["GET"]:
+            # Raised as an error by SquadApi.configure(), connection errors
+            # are first retried by the squad_client session for a while.
+            self.failures["GET"] -= 1
+            return self.reply(403, "forbidden")
+        self.reply(200, "1.80")
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        data = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+        if self.failures["POST"]:
+            self.failures["POST"] -= 1
+            return self.reply(500, "error")
+        self.submissions.append((self.path, json.loads(data["tests"][0])))
+        self.reply(201, "")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def squad():
+    FakeSquad.failures = {"GET": 0, "POST": 0}
+    FakeSquad.submissions = []
+    server = http.server.HTTPServer(("127.0.0.1", 0), FakeSquad)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def squad_uploader(test_runner, server, output):
+    args = argparse.Namespace(
+        qa_reports_server="http://127.0.0.1:%d" % server.server_port,
+        qa_reports_token="secret",
+        qa_reports_group="group",
+        qa_reports_project="project",
+        qa_reports_build_version="build",
+        qa_reports_env="env",
+        qa_reports_batch_size=2,
+        qa_reports_gzip_logs=False,
+    )
+    uploader = test_runner.SquadUploader(args, str(output))
+    uploader.POLL_INTERVAL = 0.01
+    uploader.BACKOFF = 0.01
+    return uploader
+
+
+def spool_tests(uploader, output, names):
+    for name in names:
+        log = output / ("%s.log" % name)
+        log.write_text("output of %s\n" % name)
+        uploader.spool(name, {"%s/case" % name: "pass"}, {}, {}, str(log))
+
+
+def submitted():
+    return sorted(name for path, tests in FakeSquad.submissions for name in tests)
+
+
+def test_squad_uploader_retries(squad, tmp_path):
+    test_runner = load_test_runner()
+    uploader = squad_uploader(test_runner, squad, tmp_path)
+    spool_tests(uploader, tmp_path, ["a", "b", "c"])
+    assert len(uploader.pending()) == 3
+
+    # Neither a failure to connect at startup nor a failed submission
+    # loses results.
+    FakeSquad.failures = {"GET": 1, "POST": 1}
+    uploader.start()
+    uploader.close()
+    assert uploader.pending() == []
+    assert submitted() == ["a/case", "b/case", "c/case"]
+    assert {path for path, tests in FakeSquad.submissions} == {
+        "/api/submit/group/project/build/env/"
+    }
+
+
+def test_squad_uploader_resends_leftovers(squad, tmp_path):
+    test_runner = load_test_runner()
+    uploader = squad_uploader(test_runner, squad, tmp_path)
+    spool_tests(uploader, tmp_path, ["a", "b", "c"])
+    FakeSquad.failures = {"GET": 0, "POST": 1000}
+    uploader.start()
+    uploader.close()
+    assert len(uploader.pending()) == 3
+    assert submitted() == []
+
+    # The next run with the same output directory sends them.
+    FakeSquad.failures = {"GET": 0, "POST": 0}
+    uploader = squad_uploader(test_runner, squad, tmp_path)
+    spool_tests(uploader, tmp_path, ["d"])
+    uploader.start()
+    uploader.close()
+    assert uploader.pending() == []
+    assert submitted() == ["a/case", "b/case", "c/case", "d/case"]
+
+
+def test_squad_uploader_keeps_repeated_tests(squad, tmp_path):
+    test_runner = load_test_runner()
+    uploader = squad_uploader(test_runner, squad, tmp_path)
+    log = tmp_path / "smoke.log"
+    log.write_text("output\n")
+    # The same test definition run twice, with different results.
+    uploader.spool("smoke", {"smoke/pwd": "pass"}, {}, {}, str(log))
+    uploader.spool("smoke", {"smoke/pwd": "fail"}, {}, {}, str(log))
+    uploader.spool("other", {"other/case": "pass"}, {}, {}, str(log))
+    uploader.start()
+    uploader.close()
+    assert [tests for path, tests in FakeSquad.submissions] == [
+        {"smoke/pwd": "pass"},
+        {"smoke/pwd": "fail", "other/case": "pass"},
+    ]
+
+
+def test_squad_uploader_close_interrupts_backoff(squad, tmp_path):
+    test_runner = load_test_runner()
+    uploader = squad_uploader(test_runner, squad, tmp_path)
+    uploader.BACKOFF = 1000
+    uploader.FINAL_BACKOFF_MAX = 0.01
+    spool_tests(uploader, tmp_path, ["a"])
+    FakeSquad.failures = {"GET": 0, "POST": 1000}
+    uploader.start()
+    time.sleep(0.5)
+    start = time.monotonic()
+    uploader.close()
+    assert time.monotonic() - start < 10
+    assert len(uploader.pending()) == 1
+
+
+@pytest.mark.skipif(
+    not os.path.exists("/proc/self/clear_refs"), reason="needs Linux clear_refs"
+)
+def test_phase_peak_rss():
+    test_runner = load_test_runner()
+    Timings = test_runner.Timings
+    Timings.reset()
+    with Timings.phase("outer"):
+        with Timings.phase("allocate"):
+            buffer = bytearray(100 * 1024 * 1024)
+            del buffer
+        with Timings.phase("idle"):
+            pass
+    peaks = {phase["phase"]: phase["max_rss"] for phase in Timings.phases}
+    assert peaks["outer/allocate"] > peaks["outer/idle"] + 90 * 1024
+    # A phase includes the peaks of the phases inside it.
+    assert peaks["outer"] >= peaks["outer/allocate"]
+
+
+def test_resource_samples_without_proc_stat(tmp_path):
+    test_runner = load_test_runner()
+    sampler = test_runner.ResourceSampler.__new__(test_runner.ResourceSampler)
+    sampler.interval = 1
+    sampler.raw_path = str(tmp_path / "resources.raw")
+    # A container without /proc/stat nor /proc/meminfo.
+    with open(sampler.raw_path, "w") as f:
+        for uptime in [10.0, 11.0, 12.0]:
+            f.write("@ %s\nfreq\ntemp 45000\nthrottle\n" % uptime)
+    series = sampler.series(sampler.samples())
+    assert series["cpu_util"] == [None, None]
+    assert series["mem_used_mb"] == [None, None]
+    assert series["irq_per_s"] == [None, None]
+    assert series["summary"] == [
+        ["temp-max", 45.0, "C"],
+        ["throttle-events", 0, "events"],
+    ]
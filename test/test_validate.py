@@ -0,0 +1,181 @@
+"""Tests of validate.py, run with: python3 -m pytest test"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def scratch_tree(path, files):
+    """Create a tree with validate.py, its library and files to validate."""
+    for name in ["validate.py", "automated/lib/py_testdef_lib.py"]:
+        os.makedirs(os.path.dirname(str(path / name)), exist_ok=True)
+        shutil.copy(os.path.join(REPO_PATH, name), str(path / name))
+    for name, content in files.items():
+        os.makedirs(os.path.dirname(str(path / name)), exist_ok=True)
+        (path / name).write_text(content)
+        if name.endswith(".sh"):
+            os.chmod(str(path / name), 0o755)
+
+
+def validate(path, *args):
+    """Run validate.py in path, with the cache and result file beside it."""
+    return subprocess.run(
+        [sys.executable, "validate.py", "-r", str(path.parent / "result.txt")]
+        + list(args),
+        cwd=str(path),
+        env=dict(
+            os.environ,
+            XDG_CACHE_HOME=str(path.parent / "cache"),
+            PYTHONDONTWRITEBYTECODE="1",
+        ),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+
+
+def validate_report(path, *args):
+    """Run validate.py in path, return its exit code and JSON report."""
+    report = path.parent / "report.json"
+    process = validate(path, "--report-format", "json", "-r", str(report), *args)
+    with open(str(report)) as f:
+        return process.returncode, json.load(f)
+
+
+@pytest.mark.skipif(shutil.which("shellcheck") is None, reason="needs shellcheck")
+def test_batched_shellcheck_output(tmp_path):
+    tree = tmp_path / "tree"
+    scratch_tree(
+        tree,
+        {
+            "s/bad.sh": "#!/bin/sh\necho $1\nls `pwd`\n",
+            "s/good.sh": '#!/bin/sh\necho "$1"\n',
+        },
+    )
+    batched = validate(tree, "--no-cache")
+    single = validate(tree, "--no-cache", "--no-batch")
+    assert batched.returncode == single.returncode == 1
+    # Failing scripts are reported with shellcheck's own output.
+    assert batched.stdout == single.stdout
+    assert "Did you mean:" in batched.stdout
+    assert "* SHELLCHECK: [FAILED]: ./s/bad.sh" in batched.stdout
+    assert "good.sh" not in batched.stdout
+
+
+def test_result_cache(tmp_path):
+    tree = tmp_path / "tree"
+    scratch_tree(
+        tree,
+        {
+            "plans/good.yaml": "name: good\n",
+            "plans/bad.yaml": "tests: [\n",
+            "notes.txt": "notes\n",
+        },
+    )
+
+    def statuses(report):
+        return {f["path"]: f["status"] for f in report["files"]}
+
+    exitcode, first = validate_report(tree)
+    files = len(first["files"])
+    assert first["summary"]["cache"] == {"hits": 0, "misses": files}
+    assert statuses(first)["./plans/bad.yaml"] == "failed"
+
+    # Failures are replayed from the cache too.
+    assert validate(tree).stdout == validate(tree, "--no-cache").stdout
+    exitcode_cached, cached = validate_report(tree)
+    assert cached["summary"]["cache"] == {"hits": files, "misses": 0}
+    assert exitcode_cached == exitcode == 1
+    assert statuses(cached) == statuses(first)
+
+    # A changed file is validated again.
+    (tree / "plans" / "bad.yaml").write_text("tests: []\n")
+    exitcode, report = validate_report(tree)
+    assert report["summary"]["cache"] == {"hits": files - 1, "misses": 1}
+    assert exitcode == 0
+    assert statuses(report)["./plans/bad.yaml"] != "failed"
+
+    # So are all files when the options or the validation code change.
+    exitcode, report = validate_report(tree, "-p", "E501", "E225")
+    assert report["summary"]["cache"] == {"hits": 0, "misses": files}
+    # Results for the former options are kept.
+    exitcode, report = validate_report(tree)
+    assert report["summary"]["cache"] == {"hits": files, "misses": 0}
+    with open(str(tree / "automated" / "lib" / "py_testdef_lib.py"), "a") as f:
+        f.write("\n# Changed.\n")
+    exitcode, report = validate_report(tree)
+    assert report["summary"]["cache"] == {"hits": 0, "misses": files}
+
+
+def git(path, *args):
+    subprocess.check_call(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com"]
+        + list(args),
+        cwd=str(path),
+        stdout=subprocess.DEVNULL,
+    )
+
+
+def yaml_testdef(name, steps):
+    return (
+        "metadata:\n  name: %s\n  format: Lava-Test Test Definition 1.0\n"
+        "run:\n  steps:\n" % name
+    ) + "".join("    - %s\n" % step for step in steps)
+
+
+def test_git_change_set(tmp_path):
+    tree = tmp_path / "tree"
+    scratch_tree(
+        tree,
+        {
+            "automated/lib/sh-test-lib": 'info_msg() { echo "$1"; }\n',
+            "automated/linux/a/a.yaml": yaml_testdef(
+                "a", ["cd ./automated/linux/a/", "./a.sh"]
+            ),
+            "automated/linux/a/a.sh": "#!/bin/sh\n. ../../lib/sh-test-lib\n",
+            "automated/linux/b/b.yaml": yaml_testdef(
+                "b", ["cd ./automated/linux/b/", "./b.py"]
+            ),
+            "automated/linux/b/b.py": "#!/usr/bin/env python3\nimport helper\n",
+            "automated/linux/b/helper.py": "VALUE = 1\n",
+        },
+    )
+    git(tree, "init", "-q")
+    git(tree, "add", ".")
+    git(tree, "commit", "-q", "-m", "base")
+    git(tree, "branch", "-M", "master")
+
+    def changed(*args):
+        report = validate_report(tree, *args)[1]
+        return sorted(f["path"] for f in report["files"])
+
+    # Test definitions using a changed file are checked, directly or through
+    # the scripts they run.
+    with open(str(tree / "automated" / "lib" / "sh-test-lib"), "a") as f:
+        f.write('warn_msg() { echo "$1"; }\n')
+    git(tree, "commit", "-q", "-a", "-m", "lib")
+    assert changed("-g") == ["automated/lib/sh-test-lib", "automated/linux/a/a.yaml"]
+    (tree / "automated" / "linux" / "b" / "helper.py").write_text("VALUE = 2\n")
+    assert changed("--git-diff", "HEAD") == [
+        "automated/linux/b/b.yaml",
+        "automated/linux/b/helper.py",
+    ]
+    git(tree, "commit", "-q", "-a", "-m", "helper")
+
+    # Deleted files are not validated, the test definitions using them are.
+    git(tree, "checkout", "-q", "-b", "topic", "HEAD~2")
+    git(tree, "rm", "-q", "automated/linux/a/a.sh")
+    git(tree, "commit", "-q", "-m", "delete")
+    assert changed("--git-merge-base", "master") == ["automated/linux/a/a.yaml"]
+    assert changed("--git-diff", "master...HEAD") == ["automated/linux/a/a.yaml"]
+
+    # Nothing validated is a failure.
+    process = validate(tree, "--git-diff", "unknown..HEAD")
+    assert process.returncode == 1
+    assert "Cannot get the changes of unknown..HEAD" in process.stdout
@@ -1,11 +1,28 @@
 #!/usr/bin/python3
 import argparse
+import contextlib
+import copy
+import functools
+import glob
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
 import os
+import re
 import sys
 import subprocess
+import time
 import traceback
+import xml.etree.ElementTree as ET
 import yaml
 
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "automated/lib")
+)
+import py_testdef_lib  # nopep8
+
 run_pycodestyle = False
 try:
     import pycodestyle
@@ -29,9 +46,31 @@ def print_stderr(message):
     sys.stderr.write("\n")
 
 
+def add_time(args, checker, seconds):
+    timings = getattr(args, "timings", None)
+    if timings is not None:
+        timings[checker] = timings.get(checker, 0) + seconds
+
+
+@contextlib.contextmanager
+def timed(args, checker):
+    """Add the wall time of the block to the checker timings of the file."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(args, checker, time.perf_counter() - start)
+
+
 def publish_result(result_message_list, args):
     if result_message_list:
         result_message = "\n".join(result_message_list)
+        if getattr(args, "result_buffer", None) is not None:
+            # Written to the result file by the main process.
+            args.result_buffer.append(result_message + "\n")
+            if args.verbose:
+                print_stderr(result_message)
+            return
         try:
             f = open(args.result_file, "a")
             f.write(result_message)
@@ -47,6 +86,7 @@ def publish_result(result_message_list, args):
         print_stderr(result_message)
 
 
+@functools.lru_cache(maxsize=None)
 def detect_abi():
     # Retrieve the current canonical abi from
     # automated/lib/sh-test-lib:detect_abi
@@ -59,12 +99,22 @@ def detect_abi():
     )
 
 
+# One pycodestyle.StyleGuide per process, by ignore list.
+pycodestyle_checkers = {}
+
+
 def pycodestyle_check(filepath, args):
     _fmt = "%(row)d:%(col)d: %(code)s %(text)s"
-    options = {"ignore": args.pycodestyle_ignore, "show_source": True}
-    pycodestyle_checker = pycodestyle.StyleGuide(options)
+    ignore = tuple(args.pycodestyle_ignore)
+    if ignore not in pycodestyle_checkers:
+        options = {"ignore": args.pycodestyle_ignore, "show_source": True}
+        pycodestyle_checkers[ignore] = pycodestyle.StyleGuide(options)
+    pycodestyle_checker = pycodestyle_checkers[ignore]
+    # A new report per file, statistics are printed for this file only.
     fchecker = pycodestyle_checker.checker_class(
-        filepath, options=pycodestyle_checker.options
+        filepath,
+        options=pycodestyle_checker.options,
+        report=pycodestyle_checker.init_report(),
     )
     fchecker.check_all()
     if fchecker.report.file_errors > 0:
@@ -92,7 +142,7 @@ def pycodestyle_check(filepath, args):
     return 0
 
 
-def validate_yaml_contents(filepath, args):
+def validate_yaml_contents(filepath, args, testdef=None):
     def validate_testdef_yaml(y, args):
         result_message_list = []
         if "metadata" not in y.keys():
@@ -149,15 +199,16 @@ def validate_yaml_contents(filepath, args):
         return 0
 
     def validate_skipgen_yaml(filepath, args):
-        abi = detect_abi()
         # Run skipgen on skipgen yaml file to check for output and errors
-        skips = (
-            subprocess.check_output(
-                "automated/bin/{}/skipgen {}".format(abi, filepath), shell=True
-            )
-            .decode("utf-8")
-            .strip()
-        )
+        if filepath in skipgen_results:
+            returncode, output = skipgen_results.pop(filepath)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(
+                    returncode, skipgen_command(filepath), output
+                )
+        else:
+            output = subprocess.check_output(skipgen_command(filepath))
+        skips = output.decode("utf-8").strip()
         if len(skips.split("\n")) < 1:
             message = "* SKIPGEN [FAILED]: " + filepath + " - No skips found"
             publish_result([message], args)
@@ -166,22 +217,22 @@ def validate_yaml_contents(filepath, args):
         publish_result(["* SKIPGEN [PASSED]: " + filepath], args)
         return 0
 
-    filecontent = None
-    try:
-        with open(filepath, "r") as f:
-            filecontent = f.read()
-    except FileNotFoundError:
-        publish_result(
-            ["* YAMLVALIDCONTENTS [PASSED]: " + filepath + " - deleted"], args
-        )
-        return 0
-    y = yaml.load(filecontent, Loader=yaml.FullLoader)
-    if "run" in y.keys():
+    if testdef is None:
+        try:
+            testdef = py_testdef_lib.load(filepath)
+        except FileNotFoundError:
+            publish_result(
+                ["* YAMLVALIDCONTENTS [PASSED]: " + filepath + " - deleted"], args
+            )
+            return 0
+    if testdef.kind == "testdef":
         # test definition yaml file
-        return validate_testdef_yaml(y, args)
-    elif "skiplist" in y.keys():
+        with timed(args, "metadata"):
+            return validate_testdef_yaml(testdef.data, args)
+    elif testdef.kind == "skipgen":
         # skipgen yaml file
-        return validate_skipgen_yaml(filepath, args)
+        with timed(args, "skipgen"):
+            return validate_skipgen_yaml(filepath, args)
     else:
         publish_result(
             [
@@ -195,18 +246,21 @@ def validate_yaml_contents(filepath, args):
 
 
 def validate_yaml(filename, args):
-    filecontent = None
+    """
+    Parse the YAML file. Return the exit code and the parsed TestDef, None
+    if the file is deleted or invalid.
+    """
     try:
-        with open(filename, "r") as f:
-            filecontent = f.read()
-    except FileNotFoundError:
-        publish_result(["* YAMLVALID [PASSED]: " + filename + " - deleted"], args)
-        return 0
-    try:
-        yaml.load(filecontent, Loader=yaml.FullLoader)
+        if filename in yaml_testdefs:
+            testdef = yaml_testdefs.pop(filename)
+        else:
+            testdef = py_testdef_lib.load(filename)
         if args.verbose:
             message = "* YAMLVALID: [PASSED]: " + filename
             print_stderr(message)
+    except FileNotFoundError:
+        publish_result(["* YAMLVALID [PASSED]: " + filename + " - deleted"], args)
+        return 0, None
     except yaml.YAMLError:
         message = "* YAMLVALID: [FAILED]: " + filename
         result_message_list = []
@@ -217,11 +271,11 @@ def validate_yaml(filename, args):
             result_message_list.append(" " + line)
         publish_result(result_message_list, args)
         args.failed_message_list = args.failed_message_list + result_message_list
-        return 1
-    return 0
+        return 1, None
+    return 0, testdef
 
 
-def validate_shell(filename, ignore_options):
+def shellcheck_command(args):
     ignore_string = ""
     if args.shellcheck_ignore is not None:
         # Exclude types of warnings in the following format:
@@ -229,8 +283,14 @@ def validate_shell(filename, ignore_options):
         ignore_string = "-e %s" % ",".join(args.shellcheck_ignore)
     if len(ignore_string) < 4:  # contains only "-e "
         ignore_string = ""
-    cmd = "shellcheck %s" % ignore_string
-    return validate_external(cmd, filename, "SHELLCHECK", args)
+    return "shellcheck %s" % ignore_string
+
+
+def validate_shell(filename, args):
+    if filename in shellcheck_results:
+        status, output = shellcheck_results.pop(filename)
+        return report_external(status, output, filename, "SHELLCHECK", args)
+    return validate_external(shellcheck_command(args), filename, "SHELLCHECK", args)
 
 
 def validate_php(filename, args):
@@ -241,6 +301,10 @@ def validate_php(filename, args):
 def validate_external(cmd, filename, prefix, args):
     final_cmd = "%s %s 2>&1" % (cmd, filename)
     status, output = subprocess.getstatusoutput(final_cmd)
+    return report_external(status, output, filename, prefix, args)
+
+
+def report_external(status, output, filename, prefix, args):
     if status == 0:
         message = "* %s: [PASSED]: %s" % (prefix, filename)
         publish_result([message], args)
@@ -256,23 +320,115 @@ def validate_external(cmd, filename, prefix, args):
     return 0
 
 
+# (status, output) of batched shellcheck runs, by file.
+shellcheck_results = {}
+
+
+def shellcheck_batch(filenames, args):
+    """
+    Run shellcheck once for all filenames and keep the files passing in
+    shellcheck_results, for validate_shell(). Failing files are checked
+    again on their own, so that their report is shellcheck's own output.
+    Files are also left to one shellcheck run each when the batch fails,
+    e.g. because a file is missing or shellcheck isn't installed.
+    """
+    if not filenames:
+        return
+    cmd = shellcheck_command(args).split() + ["-f", "json", "--"] + filenames
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return
+    if proc.returncode not in [0, 1]:
+        return
+    try:
+        comments = json.loads(proc.stdout.decode("utf-8"))
+    except ValueError:
+        return
+    failing = set(comment["file"] for comment in comments)
+    for filename in filenames:
+        if filename not in failing:
+            shellcheck_results[filename] = (0, "")
+
+
+# TestDefs parsed ahead by check_batch(), by file.
+yaml_testdefs = {}
+# Checker wall time spent ahead by check_batch(), by file.
+batch_times = {}
+# libmagic MIME types, by file.
+mime_types = {}
+# (returncode, output) of skipgen runs started by skipgen_batch(), by file.
+skipgen_results = {}
+
+
+def skipgen_command(filepath):
+    return ["automated/bin/%s/skipgen" % detect_abi(), filepath]
+
+
+def skipgen_batch(filenames):
+    """Run skipgen on all skipgen yaml files at once."""
+    procs = []
+    for filename in filenames:
+        try:
+            procs.append(
+                (
+                    filename,
+                    subprocess.Popen(skipgen_command(filename), stdout=subprocess.PIPE),
+                )
+            )
+        except OSError:
+            # Left to validate_skipgen_yaml().
+            pass
+    for filename, proc in procs:
+        output = proc.communicate()[0]
+        skipgen_results[filename] = (proc.returncode, output)
+
+
+def mime_type(path):
+    """libmagic MIME type of path, looked up once per file."""
+    if path not in mime_types:
+        mime_types[path] = magic.from_file(path, mime=True)
+    return mime_types[path]
+
+
+def checker_type(path):
+    """Return the checker validate_file() uses for path."""
+    # libmagic takes yaml as 'text/plain', so use file extension here.
+    if path.endswith((".yaml", ".yml")):
+        return "yaml"
+    filetype = mime_type(path)
+    if run_pycodestyle and filetype == "text/x-python":
+        return "pycodestyle"
+    elif filetype == "text/x-php":
+        return "php"
+    elif path.endswith(".sh") or filetype == "text/x-shellscript":
+        return "shellcheck"
+    return None
+
+
 def validate_file(args, path):
     if args.verbose:
         print("Validating file: %s" % path)
-    filetype = magic.from_file(path, mime=True)
-    exitcode = 0
     # libmagic takes yaml as 'text/plain', so use file extension here.
     if path.endswith((".yaml", ".yml")):
-        exitcode = validate_yaml(path, args)
+        with timed(args, "yamlvalid"):
+            exitcode, testdef = validate_yaml(path, args)
         if exitcode == 0:
             # if yaml isn't valid there is no point in checking metadata
-            exitcode = validate_yaml_contents(path, args)
-    elif run_pycodestyle and filetype == "text/x-python":
-        exitcode = pycodestyle_check(path, args)
+            exitcode = validate_yaml_contents(path, args, testdef)
+        return exitcode
+    with timed(args, "magic"):
+        filetype = mime_type(path)
+    exitcode = 0
+    if run_pycodestyle and filetype == "text/x-python":
+        with timed(args, "pycodestyle"):
+            exitcode = pycodestyle_check(path, args)
     elif filetype == "text/x-php":
-        exitcode = validate_php(path, args)
+        with timed(args, "phplint"):
+            exitcode = validate_php(path, args)
     elif path.endswith(".sh") or filetype == "text/x-shellscript":
-        exitcode = validate_shell(path, args)
+        with timed(args, "shellcheck"):
+            exitcode = validate_shell(path, args)
     else:
         publish_result(
             [
@@ -287,32 +443,492 @@ def validate_file(args, path):
     return exitcode
 
 
+# Maximum number of files passed to one checker run.
+BATCH_SIZE = 16
+
+# Cache entries not used for that many days are dropped.
+CACHE_EXPIRY = 30 * 24 * 3600
+
+
+def checker_fingerprint(args):
+    """
+    Everything, besides the file itself, a validation result depends on:
+    checker versions, options, and the validation code.
+    """
+    fingerprint = {
+        "pycodestyle": pycodestyle.__version__,
+        "pycodestyle_ignore": args.pycodestyle_ignore,
+        "shellcheck_ignore": args.shellcheck_ignore,
+        "verbose": args.verbose,
+        "batch": args.batch,
+    }
+    for tool in ["shellcheck", "php"]:
+        fingerprint[tool] = subprocess.getstatusoutput("%s --version" % tool)
+    files = [__file__, py_testdef_lib.__file__, "automated/lib/sh-test-lib"]
+    files.extend(sorted(glob.glob("automated/bin/*/skipgen")))
+    for path in files:
+        try:
+            with open(path, "rb") as f:
+                fingerprint[path] = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            fingerprint[path] = None
+    return hashlib.sha1(
+        json.dumps(fingerprint, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def cache_key(path, fingerprint):
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+    except OSError:
+        # Missing files are reported as deleted, never cached.
+        return None
+    key = hashlib.sha1(content)
+    key.update(b"\0" + path.encode("utf-8") + b"\0" + fingerprint.encode("utf-8"))
+    return key.hexdigest()
+
+
+def load_cache(path):
+    if path is None:
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    if path is None:
+        return
+    now = time.time()
+    cache = {k: v for k, v in cache.items() if now - v["time"] < CACHE_EXPIRY}
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.%d" % (path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print_stderr("Cannot write validation cache: %s" % e)
+
+
+worker_args = None
+
+
+def init_worker(args):
+    global worker_args
+    worker_args = args
+
+
+def share_time(paths, checker, seconds):
+    """Account the wall time of a batched checker run evenly to its files."""
+    for path in paths:
+        batch_times[path][checker] = seconds / len(paths)
+
+
+def check_batch(paths):
+    """
+    Validate paths, in a worker process. YAML files are parsed and batched
+    checkers started for the whole list first.
+    """
+    args = worker_args
+    if args.batch:
+        shell_files = []
+        skip_files = []
+        for path in paths:
+            start = time.perf_counter()
+            try:
+                checker = checker_type(path)
+                if checker == "shellcheck":
+                    shell_files.append(path)
+                elif checker == "yaml":
+                    # Parsed once, for validate_yaml() too.
+                    testdef = py_testdef_lib.load(path)
+                    yaml_testdefs[path] = testdef
+                    if testdef.kind == "skipgen":
+                        skip_files.append(path)
+            except Exception:
+                # Reported by validate_file().
+                checker = None
+            checker = "yamlvalid" if checker == "yaml" else "magic"
+            batch_times[path] = {checker: time.perf_counter() - start}
+        start = time.perf_counter()
+        skipgen_batch(skip_files)
+        share_time(skip_files, "skipgen", time.perf_counter() - start)
+        start = time.perf_counter()
+        shellcheck_batch(shell_files, args)
+        share_time(shell_files, "shellcheck", time.perf_counter() - start)
+    return [check_file(path) for path in paths]
+
+
+def check_file(path):
+    """
+    Validate one file, in a worker process. Everything validate_file()
+    would print or publish is captured and returned, for the main process
+    to replay in file order, and to cache.
+    """
+    args = worker_args
+    args.result_buffer = []
+    args.failed_message_list = []
+    args.timings = batch_times.pop(path, {})
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    fatal = False
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            exitcode = validate_file(args, path)
+        except SystemExit as e:
+            # validate_file() gives up on the whole run for some errors.
+            exitcode = e.code
+            fatal = True
+    return {
+        "exitcode": exitcode,
+        "fatal": fatal,
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+        "results": args.result_buffer,
+        "failed": args.failed_message_list,
+        "timings": args.timings,
+    }
+
+
+class ResultWriter(object):
+    """
+    Write the result file, kept open for the whole run.
+
+    The 'text' format appends the result messages, as they come. The 'json'
+    and 'junit' formats are written when the writer is closed, with the
+    checker wall times of every file and the cache statistics.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.format = args.report_format
+        self.start = time.time()
+        self.files = []
+        self.cache_hits = 0
+        self.cache_misses = 0
+        try:
+            self.f = open(args.result_file, "a" if self.format == "text" else "w")
+        except IOError as e:
+            print(e)
+            print_stderr("Cannot write to result file: %s" % args.result_file)
+            self.f = None
+
+    def add(self, path, result, cached):
+        """Replay the output of one file validation and record its result."""
+        sys.stdout.write(result["stdout"])
+        sys.stderr.write(result["stderr"])
+        self.args.failed_message_list.extend(result["failed"])
+        if cached:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+        if self.format == "text":
+            if self.f is not None and result["results"]:
+                self.f.write("".join(result["results"]))
+            return
+        messages = "".join(result["results"]).splitlines()
+        timings = result.get("timings", {})
+        if result["exitcode"] != 0:
+            status = "failed"
+        elif any("[PASSED]" in m for m in messages):
+            status = "passed"
+        elif any("[SKIPPED]" in m for m in messages):
+            status = "skipped"
+        else:
+            status = "passed"
+        self.files.append(
+            {
+                "path": path,
+                "status": status,
+                "cached": cached,
+                "time": sum(timings.values()),
+                "checkers": timings,
+                "messages": messages,
+            }
+        )
+
+    def summary(self):
+        checkers = {}
+        for f in self.files:
+            if f["cached"]:
+                continue
+            for checker, seconds in f["checkers"].items():
+                total = checkers.setdefault(checker, {"files": 0, "time": 0})
+                total["files"] += 1
+                total["time"] += seconds
+        return {
+            "files": len(self.files),
+            "passed": len([f for f in self.files if f["status"] == "passed"]),
+            "failed": len([f for f in self.files if f["status"] == "failed"]),
+            "skipped": len([f for f in self.files if f["status"] == "skipped"]),
+            "cache": {"hits": self.cache_hits, "misses": self.cache_misses},
+            # Time spent by checkers in this run, cached files excluded.
+            "checkers": checkers,
+            "time": time.time() - self.start,
+        }
+
+    def write_json(self):
+        json.dump({"summary": self.summary(), "files": self.files}, self.f, indent=4)
+        self.f.write("\n")
+
+    def write_junit(self):
+        summary = self.summary()
+        suite = ET.Element(
+            "testsuite",
+            name="validate",
+            tests=str(summary["files"]),
+            failures=str(summary["failed"]),
+            skipped=str(summary["skipped"]),
+            time="%.3f" % summary["time"],
+        )
+        properties = ET.SubElement(suite, "properties")
+        for name in ["hits", "misses"]:
+            ET.SubElement(
+                properties,
+                "property",
+                name="cache-%s" % name,
+                value=str(summary["cache"][name]),
+            )
+        for f in self.files:
+            case = ET.SubElement(
+                suite,
+                "testcase",
+                # The checker the file type was dispatched to.
+                classname=(list(f["checkers"]) or ["unknown"])[-1],
+                name=f["path"],
+                time="%.3f" % f["time"],
+            )
+            if f["status"] == "failed":
+                failure = ET.SubElement(case, "failure", message=f["messages"][0])
+                failure.text = "\n".join(f["messages"])
+            elif f["status"] == "skipped":
+                ET.SubElement(case, "skipped", message="\n".join(f["messages"]))
+        testsuites = ET.Element("testsuites")
+        testsuites.append(suite)
+        self.f.write(ET.tostring(testsuites, encoding="unicode"))
+        self.f.write("\n")
+
+    def close(self):
+        if self.f is None:
+            return
+        if self.format == "json":
+            self.write_json()
+        elif self.format == "junit":
+            self.write_junit()
+        self.f.close()
+        if self.args.verbose:
+            print_stderr(
+                "Validation cache: %d hits, %d misses"
+                % (self.cache_hits, self.cache_misses)
+            )
+
+
 def run_unit_tests(args, filelist=None):
-    exitcode = 0
-    if filelist is not None:
-        for filename in filelist:
-            tmp_exitcode = validate_file(args, filename)
-            if tmp_exitcode != 0:
-                exitcode = 1
-    else:
+    if filelist is None:
+        filelist = []
         for root, dirs, files in os.walk("."):
             if not root.startswith("./.git"):
                 for name in files:
-                    tmp_exitcode = validate_file(args, root + "/" + name)
-                    if tmp_exitcode != 0:
-                        exitcode = 1
+                    filelist.append(root + "/" + name)
+
+    cache_file = None if args.no_cache else args.cache_file
+    cache = load_cache(cache_file)
+    fingerprint = checker_fingerprint(args)
+    keys = [cache_key(path, fingerprint) for path in filelist]
+    todo = [path for path, key in zip(filelist, keys) if key not in cache]
+
+    jobs = max(1, min(args.jobs, len(todo)))
+    size = max(1, min(BATCH_SIZE, -(-len(todo) // jobs)))
+    batches = [todo[i : i + size] for i in range(0, len(todo), size)]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, init_worker, (args,))
+        checked = itertools.chain.from_iterable(pool.imap(check_batch, batches))
+    else:
+        pool = None
+        init_worker(copy.copy(args))
+        checked = itertools.chain.from_iterable(map(check_batch, batches))
+
+    exitcode = 0
+    now = time.time()
+    writer = ResultWriter(args)
+    try:
+        for path, key in zip(filelist, keys):
+            cached = key in cache
+            if cached:
+                result = cache[key]
+            else:
+                result = next(checked)
+                if key is not None and not result["fatal"]:
+                    cache[key] = result
+            result["time"] = now
+            writer.add(path, result, cached)
+            if result["fatal"]:
+                exit(result["exitcode"])
+            if result["exitcode"] != 0:
+                exitcode = 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+        writer.close()
+        save_cache(cache_file, cache)
     return exitcode
 
 
+# File names, and directories changed to, in scripts and test definitions.
+PATH_TOKEN = re.compile(r"[\w.+/-]+")
+CD_COMMAND = re.compile(r"\bcd\s+[\"']?([\w.+/-]+)")
+# Modules imported by Python scripts.
+PYTHON_IMPORT = re.compile(r"^\s*(?:from|import)\s+([\w.]+)", re.MULTILINE)
+
+
+def git_files(git_args):
+    """Run git and return the NUL separated names it prints."""
+    output = subprocess.check_output(["git"] + git_args + ["-z"])
+    return [name for name in output.decode("utf-8").split("\0") if name]
+
+
+def git_diff(revisions):
+    """
+    Return the files changed and deleted by a 'git diff' of revisions: a
+    commit compared to the working tree, a range 'A..B' or a merge-base
+    diff 'A...B'. Renames are reported as a deletion and an addition.
+    """
+    fields = git_files(["diff", "--name-status", "--no-renames", revisions])
+    changed = []
+    deleted = []
+    for status, name in zip(fields[0::2], fields[1::2]):
+        if status == "D":
+            deleted.append(name)
+        else:
+            changed.append(name)
+    return changed, deleted
+
+
+def file_references(path, files, directories):
+    """
+    Return the files of the repository named in path, relative to its
+    directory, to the repository root or to a directory it changes to.
+    """
+    try:
+        with open(path, "rb") as f:
+            content = f.read(1024 * 1024)
+    except OSError:
+        return set()
+    if b"\0" in content[:8192]:
+        # Binary file.
+        return set()
+    text = content.decode("utf-8", "replace")
+    directory = os.path.dirname(path)
+    bases = set(["", directory])
+    for cd in CD_COMMAND.findall(text):
+        bases.add(os.path.normpath(cd))
+        bases.add(os.path.normpath(os.path.join(directory, cd)))
+    references = set()
+    # Directories named in the file, e.g. added to sys.path.
+    module_dirs = set([directory])
+    for token in set(PATH_TOKEN.findall(text)):
+        if "/" not in token and "." not in token:
+            continue
+        # '${TEST_DIR}/../lib' is taken as relative, not as '/../lib'.
+        token = token.lstrip("/")
+        for base in bases:
+            candidate = os.path.normpath(os.path.join(base, token))
+            if candidate in files and candidate != path:
+                references.add(candidate)
+            elif candidate + "/" in directories:
+                module_dirs.add(candidate)
+    if path.endswith(".py"):
+        for module in set(PYTHON_IMPORT.findall(text)):
+            for module_dir in module_dirs:
+                candidate = os.path.normpath(
+                    os.path.join(module_dir, module.replace(".", "/") + ".py")
+                )
+                if candidate in files:
+                    references.add(candidate)
+    return references
+
+
+def dependency_index(files):
+    """
+    Map files of the repository to the test definitions using them: the
+    scripts, skipfiles and libraries a test definition names, and the
+    files those name in turn.
+    """
+    directories = set()
+    for path in files:
+        directory = os.path.dirname(path)
+        while directory and directory + "/" not in directories:
+            directories.add(directory + "/")
+            directory = os.path.dirname(directory)
+    references = {}
+    index = {}
+    for path in sorted(files):
+        if not path.endswith((".yaml", ".yml")):
+            continue
+        try:
+            if py_testdef_lib.load(path).kind != "testdef":
+                continue
+        except Exception:
+            continue
+        seen = set([path])
+        todo = [path]
+        while todo:
+            name = todo.pop()
+            if name not in references:
+                references[name] = file_references(name, files, directories)
+            for dependency in references[name] - seen:
+                seen.add(dependency)
+                todo.append(dependency)
+        for name in seen:
+            index.setdefault(name, set()).add(path)
+    return index
+
+
+def change_set(revisions, args):
+    """
+    Return the files to validate for a git diff of revisions: the changed
+    files, and the test definitions depending on changed or deleted files.
+    None if git fails, after printing the error.
+    """
+    try:
+        changed, deleted = git_diff(revisions)
+        files = set(git_files(["ls-files"]))
+    except (OSError, subprocess.CalledProcessError) as e:
+        print_stderr("Cannot get the changes of %s: %s" % (revisions, e))
+        return None
+    # Deleted files are still named by the files depending on them.
+    index = dependency_index(files | set(deleted))
+    filelist = [name for name in changed if os.path.exists(name)]
+    for name in deleted:
+        if args.verbose:
+            print("Deleted file: %s" % name)
+    for name in changed + deleted:
+        for testdef in sorted(index.get(name, [])):
+            if testdef not in filelist and os.path.exists(testdef):
+                if args.verbose:
+                    print("Affected by %s: %s" % (name, testdef))
+                filelist.append(testdef)
+    return filelist
+
+
 def main(args):
     exitcode = 0
-    if args.git_latest:
-        # check if git exists
-        git_status, git_result = subprocess.getstatusoutput(
-            "git diff --name-only HEAD~1"
-        )
-        if git_status == 0:
-            filelist = git_result.split()
+    if args.git_latest or args.git_diff or args.git_merge_base:
+        if args.git_diff:
+            revisions = args.git_diff
+        elif args.git_merge_base:
+            revisions = "%s...HEAD" % args.git_merge_base
+        else:
+            revisions = "HEAD~1"
+        filelist = change_set(revisions, args)
+        if filelist is None:
+            # Nothing was validated: don't report success.
+            exitcode = 1
+        else:
             exitcode = run_unit_tests(args, filelist)
     elif len(args.file_path) > 0:
         exitcode = run_unit_tests(args, [args.file_path])
@@ -347,9 +963,26 @@ if __name__ == "__main__":
         action="store_true",
         default=False,
         help="If set, the script will try to evaluate files in last git \
-                            commit instead of the whole repository",
+                            commit, and the test definitions depending on \
+                            them, instead of the whole repository",
         dest="git_latest",
     )
+    parser.add_argument(
+        "--git-diff",
+        default=None,
+        help="Evaluate files changed by 'git diff REVISIONS', e.g. \
+                            origin/master..HEAD, and the test definitions \
+                            depending on them",
+        dest="git_diff",
+    )
+    parser.add_argument(
+        "--git-merge-base",
+        default=None,
+        help="Evaluate files changed since the merge base of HEAD and \
+                            the given branch, and the test definitions \
+                            depending on them",
+        dest="git_merge_base",
+    )
     parser.add_argument(
         "-f",
         "--file-path",
@@ -364,6 +997,15 @@ if __name__ == "__main__":
         help="Path to the file that contains results in case of failure",
         dest="result_file",
     )
+    parser.add_argument(
+        "--report-format",
+        choices=["text", "json", "junit"],
+        default="text",
+        help="Format of the result file. 'json' and 'junit' report every \
+                            file, with the time spent by each checker and \
+                            the validation cache statistics. Default: text",
+        dest="report_format",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -373,6 +1015,40 @@ if __name__ == "__main__":
         dest="verbose",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of files validated in parallel. Default: number of CPUs",
+        dest="jobs",
+    )
+    parser.add_argument(
+        "--no-batch",
+        action="store_false",
+        default=True,
+        help="Run shellcheck once per file rather than for many files at once",
+        dest="batch",
+    )
+    parser.add_argument(
+        "--cache-file",
+        default=os.path.join(
+            os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+            "test-definitions",
+            "validate.json",
+        ),
+        help="Validation results of unchanged files are reused from this \
+                            file. Default: %(default)s",
+        dest="cache_file",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Validate every file, without reading or updating the cache",
+        dest="no_cache",
+    )
+
     args = parser.parse_args()
     setattr(args, "failed_message_list", failed_message_list)
     main(args)